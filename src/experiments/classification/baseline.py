@@ -8,11 +8,12 @@ from backflow import task
 from backflow.schedulers import MultiThreadScheduler
 from backflow.results import sqlite_result
 from experiments.classification.policies import EpsgreedyPolicy, StatisticalPolicy, BoltzmannPolicy
-from experiments.classification.policies.statistical import TYPE_THOMPSON, TYPE_UCB
-from experiments.classification.optimization import optimize_supervised_hinge, optimize_supervised_ridge
+from experiments.classification.policies.statistical import TYPE_THOMPSON, TYPE_THOMPSON_WEIGHTS, TYPE_UCB, COVARIANCE_TYPES
+from experiments.classification.optimization import optimize_supervised_hinge, fit_ridge
 from experiments.classification.dataset import load_train, load_test
 from experiments.classification.evaluation import evaluate
 from experiments.util import rng_seed
+from experiments.serialization import cached_result
 
 
 def main():
@@ -94,7 +95,8 @@ async def evaluate_baseline(data, lr, fraction, epochs, eps, tau, seed):
     return {'policy': acc_policy, 'best': acc_best}
 
 
-@task(result_fn=sqlite_result(".cache/results.sqlite"))
+@task
+@cached_result(".cache/baselines")
 async def train_baseline(data, lr, l2, fraction, epochs, eps, tau, seed):
     train = await load_train(data)
     policy = EpsgreedyPolicy(train.k, train.d, lr=lr, eps=eps)
@@ -114,23 +116,24 @@ async def best_baseline(data, seed):
     return await train_baseline(data, seed=seed, **baselines[data])
 
 
-@task(result_fn=sqlite_result(
-    "resultdb.sqlite", as_cache=True, keep_in_memory=True))
-async def statistical_baseline(data, l2, seed, strategy):
+@task
+@cached_result(".cache/baselines")
+async def statistical_baseline(data, l2, seed, strategy, covariance='full', rank=16):
     with open("conf/classification/baselines.json", "rt") as f:
         baselines = json.load(f)
     fraction = baselines[data]['fraction']
     train = await load_train(data, seed)
     draw_type = {
         'ucb': TYPE_UCB,
-        'thompson': TYPE_THOMPSON
+        'thompson': TYPE_THOMPSON,
+        'thompson_weights': TYPE_THOMPSON_WEIGHTS
     }[strategy]
-    policy = StatisticalPolicy(train.k, train.d, l2=l2, draw_type=draw_type)
+    policy = StatisticalPolicy(train.k, train.d, l2=l2, draw_type=draw_type, covariance=COVARIANCE_TYPES[covariance], rank=rank)
     baseline_size = int(fraction * train.n)
     prng = rng_seed(seed)
     indices = prng.permutation(train.n)[0:baseline_size]
     logging.info(f"[{seed}] training ridge regression baseline (size: {baseline_size}, weights:{train.d * train.k})")
-    optimize_supervised_ridge(train, indices, policy)
+    fit_ridge(train, indices, policy)
     return policy
 
 
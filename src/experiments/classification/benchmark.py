@@ -0,0 +1,272 @@
+import logging
+import math
+import os
+import pickle
+import tempfile
+import time
+import numpy as np
+import numba
+from argparse import ArgumentParser
+from numba.runtime import rtsys
+from scipy.sparse import random as sparse_random
+from experiments.sparse import from_scipy, csr_rows_dot, SparseAccumulator
+from experiments.classification.dataset import ClassificationDataset
+from experiments.classification.optimization import optimize
+from experiments.classification.policies import create_policy, BoltzmannPolicy
+from experiments.classification.policies.util import bound_sums, softmax_into
+from experiments.classification.policies.statistical import StatisticalPolicy, thompson_probabilities, thompson_probabilities_mc
+from experiments.serialization import save, load
+from experiments.classification.util import reward
+from experiments.util import rng_seed
+
+
+def main():
+    logging.basicConfig(format="[%(asctime)s] %(levelname)-5s %(threadName)35s: %(message)s",
+                        level=logging.INFO)
+    cli_parser = ArgumentParser()
+    cli_parser.add_argument("-b", "--benchmark", choices=tuple(BENCHMARKS.keys()), required=True)
+    cli_parser.add_argument("-n", type=int, default=20000)
+    cli_parser.add_argument("-d", type=int, default=50000)
+    cli_parser.add_argument("-k", type=int, default=20)
+    cli_parser.add_argument("--density", type=float, default=0.002)
+    cli_parser.add_argument("--repeats", type=int, default=5)
+    cli_parser.add_argument("--seed", type=int, default=4200)
+    cli_parser.add_argument("--strategies", type=str, default="boltzmann,epsgreedy,ips,sea")
+    cli_parser.add_argument("--iterations", type=int, default=100000)
+    cli_parser.add_argument("--samples", type=int, default=1000)
+    cli_parser.add_argument("--policy_d", type=int, default=1000)
+    args = cli_parser.parse_args()
+
+    BENCHMARKS[args.benchmark](args)
+
+
+def random_dataset(n, d, k, density, seed):
+    prng = rng_seed(seed)
+    xs = sparse_random(n, d, density=density, format='csr', random_state=prng)
+    ys = prng.randint(k, size=n).astype(np.int32)
+    ys.setflags(write=False)
+    return ClassificationDataset(from_scipy(xs, min_d=d), ys, n, d, k)
+
+
+def timed(fn, *args, repeats=5):
+    fn(*args) # compile
+    best = np.inf
+    for _ in range(repeats):
+        start = time.perf_counter()
+        fn(*args)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def benchmark_spmm(args):
+    data = random_dataset(args.n, args.d, args.k, args.density, args.seed)
+    w = np.random.normal(0.0, 1.0, (args.d, args.k))
+    rows = np.arange(args.n, dtype=np.int32)
+    per_row = timed(_rows_dot_per_row, data, rows, w, repeats=args.repeats)
+    spmm = timed(csr_rows_dot, data.xs, rows, w, repeats=args.repeats)
+    if not np.allclose(_rows_dot_per_row(data, rows, w), csr_rows_dot(data.xs, rows, w)):
+        raise RuntimeError("SpMM kernel does not match per-row scoring")
+    logging.info(f"spmm (n={args.n}, d={args.d}, k={args.k}, density={args.density}): "
+                 f"per-row {per_row:.4f}s, spmm {spmm:.4f}s, speedup {per_row / spmm:.2f}x")
+
+
+def benchmark_bounds(args):
+    # Bound sums of SEA/Comp over an IPS history of `iterations` logged
+    # actions, against the per-row recomputation and baseline rebuild they
+    # replaced
+    data = random_dataset(args.n, args.d, args.k, args.density, args.seed)
+    prng = rng_seed(args.seed)
+    ips = SparseAccumulator((args.n, args.k))
+    _fill_ips(ips, prng.randint(0, args.n, args.iterations), prng.randint(0, args.k, args.iterations),
+              prng.uniform(0.0, 1.0, args.iterations))
+    w = np.random.normal(0.0, 0.01, (args.d, args.k))
+    # The rebuild runs after the baseline weights were replaced by `w`
+    baseline = BoltzmannPolicy(args.k, args.d, w=np.copy(w))
+    per_row = timed(_bound_sums_per_row, data, ips, w, baseline.tau, baseline, repeats=args.repeats)
+    blocked = timed(bound_sums, data.xs, ips, w, baseline.tau, baseline, repeats=args.repeats)
+    if not np.allclose(_bound_sums_per_row(data, ips, w, baseline.tau, baseline),
+                       bound_sums(data.xs, ips, w, baseline.tau, baseline)):
+        raise RuntimeError("Blocked bound sums do not match per-row recomputation")
+    logging.info(f"bounds (n={args.n}, d={args.d}, k={args.k}, rows={ips.n_rows}, entries={ips.nnz}): "
+                 f"per-row {per_row:.4f}s, blocked {blocked:.4f}s, speedup {per_row / blocked:.2f}x")
+
+
+def benchmark_interactions(args):
+    data = random_dataset(args.n, args.d, args.k, args.density, args.seed)
+    prng = rng_seed(args.seed)
+    indices = prng.randint(0, args.n, args.iterations)
+    for strategy in args.strategies.split(","):
+        policy = _benchmark_policy(strategy, data)
+        unfused = timed(lambda: _optimize_unfused(data, np.copy(indices), policy.__deepcopy__()), repeats=args.repeats)
+        fused = timed(lambda: optimize(data, np.copy(indices), np.copy(indices), policy.__deepcopy__()), repeats=args.repeats)
+        logging.info(f"interactions {strategy}: draw+update {args.iterations / unfused:.0f}/s, "
+                     f"draw_with_propensity {args.iterations / fused:.0f}/s, speedup {unfused / fused:.2f}x")
+
+
+def _benchmark_policy(strategy, data):
+    baseline = BoltzmannPolicy(data.k, data.d, w=np.random.normal(0.0, 0.01, (data.d, data.k)))
+    return create_policy(strategy, data.k, data.d, n=data.n, baseline=baseline, w=np.copy(baseline.w))
+
+
+def benchmark_allocations(args):
+    data = random_dataset(args.n, args.d, args.k, args.density, args.seed)
+    prng = rng_seed(args.seed)
+    indices = prng.randint(0, args.n, args.iterations)
+    _contexts_only(data, indices)
+    before = rtsys.get_allocation_stats().alloc
+    _contexts_only(data, indices)
+    contexts = rtsys.get_allocation_stats().alloc - before
+    for strategy in args.strategies.split(","):
+        policy = _benchmark_policy(strategy, data)
+        optimize(data, np.copy(indices[:10]), np.copy(indices[:10]), policy.__deepcopy__()) # compile
+        train_indices = np.copy(indices)
+        before = rtsys.get_allocation_stats().alloc
+        optimize(data, train_indices, train_indices, policy)
+        allocations = rtsys.get_allocation_stats().alloc - before - contexts
+        logging.info(f"allocations {strategy}: {allocations / args.iterations:.4f} per interaction "
+                     f"(excluding {contexts / args.iterations:.1f} per context lookup)")
+
+
+def benchmark_thompson(args):
+    prng = rng_seed(args.seed)
+    means = prng.normal(0.0, 1.0, (args.iterations, args.k))
+    stds = prng.uniform(0.1, 1.0, (args.iterations, args.k))
+    loop = timed(_thompson_per_action, means, stds, repeats=args.repeats)
+    pairwise = timed(_thompson_per_context, means, stds, 0, repeats=args.repeats)
+    mc = timed(_thompson_per_context, means, stds, args.samples, repeats=args.repeats)
+    error = np.mean(np.abs(_thompson_per_context(means[:1000], stds[:1000], 0) -
+                           _thompson_per_context(means[:1000], stds[:1000], args.samples)))
+    logging.info(f"thompson (k={args.k}, contexts={args.iterations}): per-action loop {loop:.4f}s, "
+                 f"pairwise {pairwise:.4f}s ({loop / pairwise:.2f}x), "
+                 f"monte-carlo/{args.samples} {mc:.4f}s ({loop / mc:.2f}x, mean abs. difference {error:.4f})")
+
+
+def benchmark_pickle(args):
+    data = random_dataset(args.n, args.d, args.k, args.density, args.seed)
+    policy = StatisticalPolicy(args.k, args.policy_d)
+    with tempfile.TemporaryDirectory() as directory:
+        for name, obj in [('dataset', data), ('statistical', policy)]:
+            in_band = os.path.join(directory, f"{name}.pkl")
+            with open(in_band, "wb") as f:
+                pickle.dump(obj, f, protocol=pickle.HIGHEST_PROTOCOL)
+            out_of_band = os.path.join(directory, f"{name}.oob")
+            save(obj, out_of_band)
+            before = timed(_load_pickle, in_band, repeats=args.repeats)
+            after = timed(load, out_of_band, repeats=args.repeats)
+            logging.info(f"cache hit {name} ({os.path.getsize(in_band) / 2**20:.1f} MiB): in-band {before:.4f}s, "
+                         f"out-of-band {after:.4f}s, speedup {before / after:.2f}x")
+
+
+def _load_pickle(path):
+    with open(path, "rb") as f:
+        return pickle.load(f)
+
+
+@numba.njit(nogil=True)
+def _thompson_per_action(means, stds):
+    # Previous implementation: every probability(x, a) query evaluated all
+    # k^2 pairs, so a full vector cost k^3 erfc calls.
+    k = means.shape[1]
+    out = np.zeros(means.shape)
+    for row in range(means.shape[0]):
+        for a in range(k):
+            ps = np.zeros(k)
+            for i in range(k):
+                for j in range(k):
+                    if i != j:
+                        ps[i] += np.log(0.5 * math.erfc((means[row, j] - means[row, i]) /
+                                                        math.sqrt(2.0 * (stds[row, i] ** 2 + stds[row, j] ** 2))))
+            out[row, a] = np.exp(ps[a])
+    return out
+
+
+@numba.njit(nogil=True)
+def _thompson_per_context(means, stds, samples):
+    out = np.zeros(means.shape)
+    for row in range(means.shape[0]):
+        if samples > 0:
+            thompson_probabilities_mc(means[row], stds[row], samples, out[row])
+        else:
+            thompson_probabilities(means[row], stds[row], out[row])
+    return out
+
+
+@numba.njit(nogil=True)
+def _contexts_only(train, train_indices):
+    total = 0.0
+    for i in range(len(train_indices)):
+        x, y = train.get(train_indices[i])
+        total += x.nnz + y
+    return total
+
+
+@numba.njit(nogil=True)
+def _optimize_unfused(train, train_indices, policy):
+    train_regret = 0.0
+    for i in range(len(train_indices)):
+        x, y = train.get(train_indices[i])
+        a = policy.draw(x)
+        r = reward(x, y, a)
+        train_regret += (1.0 - r)
+        policy.update(train, train_indices[i], a, r)
+    return train_regret
+
+
+@numba.njit(nogil=True)
+def _rows_dot_per_row(dataset, rows, w):
+    out = np.zeros((rows.shape[0], w.shape[1]))
+    for i in range(rows.shape[0]):
+        x, _ = dataset.get(rows[i])
+        out[i, :] = x.dot(w)
+    return out
+
+
+@numba.njit(nogil=True)
+def _fill_ips(ips, rows, actions, values):
+    for i in range(rows.shape[0]):
+        ips.add(rows[i], actions[i], values[i])
+
+
+@numba.njit(nogil=True)
+def _bound_sums_per_row(dataset, ips, w, tau, baseline):
+    new_sum_mean = 0.0
+    new_sum_var = 0.0
+    new_max = 0.0
+    for slot in range(ips.n_rows):
+        x, _ = dataset.get(ips.rows[slot])
+        s = x.dot(w)
+        new_ps = softmax_into(s, tau, s)
+        entry = ips.heads[slot]
+        while entry != -1:
+            new_p = new_ps[ips.cols[entry]]
+            new_sum_mean += new_p * ips.data[entry]
+            new_sum_var += new_p**2 * ips.data2[entry]
+            new_max = max(new_max, new_p * ips.data[entry])
+            entry = ips.links[entry]
+    swap_sum_mean = 0.0
+    swap_sum_var = 0.0
+    swap_max = 0.0
+    for slot in range(ips.n_rows):
+        x, _ = dataset.get(ips.rows[slot])
+        entry = ips.heads[slot]
+        while entry != -1:
+            baseline_p = baseline.probability(x, ips.cols[entry])
+            swap_sum_mean += baseline_p * ips.data[entry]
+            swap_sum_var += baseline_p**2 * ips.data2[entry]
+            swap_max = max(swap_max, baseline_p * ips.data[entry])
+            entry = ips.links[entry]
+    return new_sum_mean, new_sum_var, new_max, swap_sum_mean, swap_sum_var, swap_max
+
+
+BENCHMARKS = {
+    'spmm': benchmark_spmm,
+    'bounds': benchmark_bounds,
+    'interactions': benchmark_interactions,
+    'allocations': benchmark_allocations,
+    'thompson': benchmark_thompson,
+    'pickle': benchmark_pickle
+}
+
+
+if __name__ == "__main__":
+    main()
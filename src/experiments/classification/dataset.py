@@ -1,13 +1,22 @@
 import logging
+import io
+import os
+import bz2
+import gzip
+import shutil
+import tempfile
+import hashlib
 import numpy as np
 import numba
 import json
+import multiprocessing
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
 from backflow import task
-from backflow.results import on_disk_result
 from sklearn.datasets import load_svmlight_file
 from scipy.sparse import csr_matrix
 from collections import namedtuple
-from experiments.sparse import from_scipy
+from experiments.sparse import from_scipy, SparseMatrix
 from experiments.util import rng_seed
 
 with open("conf/classification/datasets.json", "rt") as f:
@@ -17,6 +26,10 @@ _readonly_i32_1d = np.array([0], dtype=np.int32)
 _readonly_i32_1d.setflags(write=False)
 _sparse_m = numba.typeof(from_scipy(csr_matrix((0,0))))
 
+_ARRAY_CACHE = ".cache/arrays"
+_PARSE_CHUNK = 1 << 24
+_PARSE_WORKERS = int(os.environ.get("EXPERIMENTS_PARSE_WORKERS", 0))
+
 @numba.jitclass([
     ('xs', _sparse_m),
     ('ys', numba.typeof(_readonly_i32_1d)),
@@ -99,8 +112,62 @@ def _get_many(index, xs, ys):
     return out
 
 
-@task(result_fn=on_disk_result(".cache/datasets"))
+@task
 async def load_from_path(file_path, min_d=0, sample=1.0, seed=0,  sample_inverse=False):
+    """
+    Loads a (subsampled) svmlight dataset. The parsed arrays are converted
+    once into a directory of `.npy` files, later loads memory-map them so
+    that processes share the page cache instead of holding private copies.
+    """
+    path = _array_cache_path(file_path, min_d, sample, seed, sample_inverse)
+    if not os.path.exists(path):
+        logging.info(f"converting {file_path} to {path}")
+        save_arrays(parse_svmlight_parallel(file_path, min_d, sample, seed, sample_inverse), path)
+    return load_arrays(path)
+
+
+def _array_cache_path(file_path, min_d, sample, seed, sample_inverse):
+    stat = os.stat(file_path)
+    key = json.dumps([os.path.abspath(file_path), stat.st_size, stat.st_mtime, min_d, sample, seed, sample_inverse])
+    return os.path.join(_ARRAY_CACHE, hashlib.sha1(key.encode()).hexdigest())
+
+
+def save_arrays(dataset, path):
+    """
+    Writes `dataset` as raw arrays plus a json header into the directory
+    `path`. The directory is written elsewhere first and then renamed, so
+    concurrent conversions never expose a partial cache.
+    """
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp = tempfile.mkdtemp(dir=os.path.dirname(path))
+    try:
+        np.save(os.path.join(tmp, "data.npy"), dataset.xs.data)
+        np.save(os.path.join(tmp, "indices.npy"), dataset.xs.indices)
+        np.save(os.path.join(tmp, "indptr.npy"), dataset.xs.indptr)
+        np.save(os.path.join(tmp, "ys.npy"), dataset.ys)
+        with open(os.path.join(tmp, "meta.json"), "wt") as f:
+            json.dump({'n': dataset.n, 'd': dataset.d, 'k': dataset.k, 'nnz': dataset.xs.nnz,
+                       'shape': list(dataset.xs.shape)}, f)
+        os.rename(tmp, path)
+    except OSError:
+        if not os.path.exists(path):
+            raise
+    finally:
+        shutil.rmtree(tmp, ignore_errors=True)
+
+
+def load_arrays(path):
+    with open(os.path.join(path, "meta.json"), "rt") as f:
+        meta = json.load(f)
+    # Copy-on-write maps keep the sparse arrays writable as the jitclass
+    # expects, the labels are mapped read-only.
+    load = lambda name, mode: np.asarray(np.load(os.path.join(path, name), mmap_mode=mode))
+    xs = SparseMatrix(load("data.npy", 'c'), load("indices.npy", 'c'), load("indptr.npy", 'c'),
+                      meta['nnz'], tuple(meta['shape']))
+    return ClassificationDataset(xs, load("ys.npy", 'r'), meta['n'], meta['d'], meta['k'])
+
+
+def parse_svmlight(file_path, min_d=0, sample=1.0, seed=0, sample_inverse=False):
     xs, ys = load_svmlight_file(file_path)
     ys = ys.astype(np.int32)
     ys -= np.min(ys)
@@ -121,6 +188,99 @@ async def load_from_path(file_path, min_d=0, sample=1.0, seed=0,  sample_inverse
     return ClassificationDataset(xs, ys, n, d, k)
 
 
+def parse_svmlight_parallel(file_path, min_d=0, sample=1.0, seed=0, sample_inverse=False, workers=None):
+    """
+    Parallel version of `parse_svmlight`. The file is decompressed in chunks
+    of whole lines that are tokenized by worker processes, and the CSR
+    arrays are assembled from the chunks directly. The rows, their order and
+    the index base are the same as with `parse_svmlight`.
+    """
+    workers = _parse_workers() if workers is None else workers
+    if workers <= 1:
+        return parse_svmlight(file_path, min_d, sample, seed, sample_inverse)
+    chunks = []
+    pending = deque()
+    with ProcessPoolExecutor(workers, mp_context=multiprocessing.get_context('spawn')) as executor:
+        for chunk in _read_chunks(file_path):
+            pending.append(executor.submit(_parse_chunk, chunk))
+            if len(pending) > 2 * workers:
+                chunks.append(pending.popleft().result())
+        chunks += [p.result() for p in pending]
+    data = np.concatenate([c[0] for c in chunks])
+    indices = np.concatenate([c[1] for c in chunks]).astype(np.int32)
+    nnzs = np.concatenate([c[2] for c in chunks])
+    ys = np.concatenate([c[3] for c in chunks]).astype(np.int32)
+    # Same index base detection as load_svmlight_file(zero_based='auto')
+    if indices.shape[0] > 0 and np.min(indices) > 0:
+        indices -= 1
+    d = int(np.max(indices)) + 1 if indices.shape[0] > 0 else 0
+    ys -= np.min(ys)
+    indptr = np.zeros(ys.shape[0] + 1, dtype=np.int64)
+    np.cumsum(nnzs, out=indptr[1:])
+    rows = np.arange(ys.shape[0])
+    if sample < 1.0:
+        prng = rng_seed(seed)
+        rows = prng.permutation(ys.shape[0])
+        if not sample_inverse:
+            rows = rows[0:int(sample*ys.shape[0])]
+        else:
+            rows = rows[int(sample*ys.shape[0]):]
+        ys = ys[rows]
+    data, indices, indptr = _gather_rows(data, indices, indptr, rows)
+    n = ys.shape[0]
+    k = np.unique(ys).shape[0]
+    ys.setflags(write=False)
+    xs = SparseMatrix(data, indices, indptr, data.shape[0], (n, max(min_d, d)))
+    return ClassificationDataset(xs, ys, n, d, k)
+
+
+def _parse_workers():
+    # EXPERIMENTS_PARSE_WORKERS if set, otherwise all cores in the main
+    # process and one in worker processes, which already run in parallel
+    if _PARSE_WORKERS > 0:
+        return _PARSE_WORKERS
+    if multiprocessing.current_process().name != 'MainProcess':
+        return 1
+    return os.cpu_count() or 1
+
+
+def _read_chunks(file_path, size=_PARSE_CHUNK):
+    opener = bz2.open if file_path.endswith(".bz2") else gzip.open if file_path.endswith(".gz") else open
+    with opener(file_path, "rb") as f:
+        rest = b""
+        while True:
+            block = f.read(size)
+            if not block:
+                break
+            block = rest + block
+            end = block.rfind(b"\n") + 1
+            rest = block[end:]
+            if end > 0:
+                yield block[:end]
+        if rest:
+            yield rest
+
+
+def _parse_chunk(chunk):
+    xs, ys = load_svmlight_file(io.BytesIO(chunk), zero_based=True)
+    return xs.data, xs.indices, np.diff(xs.indptr), ys
+
+
+@numba.njit(nogil=True)
+def _gather_rows(data, indices, indptr, rows):
+    out_indptr = np.zeros(rows.shape[0] + 1, dtype=np.int32)
+    for i in range(rows.shape[0]):
+        out_indptr[i + 1] = out_indptr[i] + indptr[rows[i] + 1] - indptr[rows[i]]
+    out_data = np.empty(out_indptr[-1], dtype=np.float64)
+    out_indices = np.empty(out_indptr[-1], dtype=np.int32)
+    for i in range(rows.shape[0]):
+        start = indptr[rows[i]]
+        for j in range(indptr[rows[i] + 1] - start):
+            out_data[out_indptr[i] + j] = data[start + j]
+            out_indices[out_indptr[i] + j] = indices[start + j]
+    return out_data, out_indices, out_indptr
+
+
 @task
 async def load_train(dataset, seed=0, sample=None):
     train_path = datasets[dataset]['train']['path']
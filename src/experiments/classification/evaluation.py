@@ -2,6 +2,13 @@ import numba
 import numpy as np
 from experiments.classification import dataset
 from experiments.classification.util import reward
+from experiments.classification.policies.util import argmax
+from experiments.classification.policies.statistical import TYPE_THOMPSON_WEIGHTS, COVARIANCE_FULL
+from experiments.classification.scores import ScoreTable
+from experiments.sparse import csr_rows_dot
+
+
+_EVALUATION_BLOCK = 1024
 
 
 @numba.njit(nogil=True)
@@ -17,3 +24,190 @@ def evaluate(test_data, policy, vali_indices):
         cum_r_policy += r_policy
         cum_r_best += r_best
     return cum_r_policy / len(vali_indices), cum_r_best / len(vali_indices)
+
+
+@numba.njit(nogil=True, parallel=True)
+def evaluate_parallel(test_data, policy, vali_indices):
+    """
+    Parallel version of `evaluate`. Rewards are stored per row and summed in
+    row order afterwards, so the reduction does not depend on the number of
+    threads. Rows are drawn in fixed blocks that each seed the random state
+    of their thread from the state of the caller, so the sampled actions do
+    not depend on the thread schedule either.
+    """
+    n = len(vali_indices)
+    r_policy = np.zeros(n)
+    r_best = np.zeros(n)
+    seed = np.random.randint(0, 2**31 - 1)
+    for block in numba.prange((n + _EVALUATION_BLOCK - 1) // _EVALUATION_BLOCK):
+        np.random.seed(seed + block)
+        for i in range(block * _EVALUATION_BLOCK, min(n, (block + 1) * _EVALUATION_BLOCK)):
+            x, y = test_data.get(vali_indices[i])
+            r_policy[i] = reward(x, y, policy.draw(x))
+            r_best[i] = reward(x, y, policy.max(x))
+    cum_r_policy = 0.0
+    cum_r_best = 0.0
+    for i in range(n):
+        cum_r_policy += r_policy[i]
+        cum_r_best += r_best[i]
+    return cum_r_policy / n, cum_r_best / n
+
+
+def evaluate_statistical_parallel(test_data, policy, vali_indices):
+    """
+    `evaluate_parallel` for statistical policies. Thompson weight sampling
+    refactorizes its Cholesky factors lazily, so they are brought up to date
+    here and the parallel draws only read them.
+    """
+    if policy.draw_type == TYPE_THOMPSON_WEIGHTS and policy.covariance == COVARIANCE_FULL:
+        policy._update_cholesky()
+    return evaluate_parallel(test_data, policy, vali_indices)
+
+
+def evaluate_scored(test_data, policy, vali_indices, blocks=0, expected=False):
+    """
+    Evaluates `policy` like `evaluate`, but scores blocks of rows with one
+    CSR x dense product and derives both the greedy and the sampled action
+    from it. Wrapped policies (IPS/SEA/Comp) sample from their baseline, in
+    which case the baseline weights are multiplied separately. With
+    `blocks > 0` the row blocks are evaluated in parallel. With `expected`
+    the deploy reward is the exact expectation `p(y|x)` instead of the
+    reward of one sampled action.
+    """
+    sampler = policy.baseline if hasattr(policy, 'baseline') else policy
+    shared = sampler is policy
+    if blocks > 0:
+        return _evaluate_scored_parallel(test_data, policy.w, sampler, vali_indices, shared, expected, blocks)
+    return _evaluate_scored(test_data, policy.w, sampler, vali_indices, shared, expected)
+
+
+@numba.njit(nogil=True)
+def _evaluate_scored(test_data, w, sampler, vali_indices, shared, expected):
+    r_policy = np.zeros(len(vali_indices))
+    r_best = np.zeros(len(vali_indices))
+    for start in range(0, len(vali_indices), _EVALUATION_BLOCK):
+        end = min(len(vali_indices), start + _EVALUATION_BLOCK)
+        _evaluate_block(test_data, w, sampler, vali_indices, start, end, shared, expected, r_policy, r_best)
+    return np.sum(r_policy) / len(vali_indices), np.sum(r_best) / len(vali_indices)
+
+
+@numba.njit(nogil=True, parallel=True)
+def _evaluate_scored_parallel(test_data, w, sampler, vali_indices, shared, expected, blocks):
+    r_policy = np.zeros(len(vali_indices))
+    r_best = np.zeros(len(vali_indices))
+    size = (len(vali_indices) + blocks - 1) // blocks
+    # Every block seeds the random state of its thread, like in
+    # `evaluate_parallel`, so the sampled actions are reproducible
+    seed = np.random.randint(0, 2**31 - 1)
+    for block in numba.prange(blocks):
+        np.random.seed(seed + block)
+        start = min(len(vali_indices), block * size)
+        end = min(len(vali_indices), start + size)
+        _evaluate_block(test_data, w, sampler, vali_indices, start, end, shared, expected, r_policy, r_best)
+    cum_r_policy = 0.0
+    cum_r_best = 0.0
+    for i in range(len(vali_indices)):
+        cum_r_policy += r_policy[i]
+        cum_r_best += r_best[i]
+    return cum_r_policy / len(vali_indices), cum_r_best / len(vali_indices)
+
+
+@numba.njit(nogil=True)
+def _evaluate_block(test_data, w, sampler, vali_indices, start, end, shared, expected, r_policy, r_best):
+    rows = vali_indices[start:end]
+    scores = csr_rows_dot(test_data.xs, rows, w)
+    sampled = scores if shared else csr_rows_dot(test_data.xs, rows, sampler.w)
+    probs = np.empty(scores.shape[1])
+    for b in range(end - start):
+        y = test_data.ys[rows[b]]
+        if expected:
+            r_policy[start + b] = sampler.score_probabilities(sampled[b], probs)[y]
+        else:
+            r_policy[start + b] = 1.0 if sampler.draw_scored(sampled[b]) == y else 0.0
+        r_best[start + b] = 1.0 if argmax(scores[b]) == y else 0.0
+
+
+def evaluation_snapshot(policy):
+    """
+    Returns a copy of `policy` to evaluate while training continues. Wrapped
+    policies (IPS/SEA/Comp) are copied as an `_EvaluationView`, without the
+    IPS accumulators and probability cache that evaluation does not read.
+    """
+    if hasattr(policy, 'baseline'):
+        return _EvaluationView(policy)
+    return policy.__deepcopy__()
+
+
+class _EvaluationView():
+    # What `evaluate_scored`, `incremental_evaluator` and the progress log
+    # read from a wrapped policy
+    def __init__(self, policy):
+        self.k = policy.k
+        self.w = np.copy(policy.w)
+        self.baseline = policy.baseline.__deepcopy__()
+        if hasattr(policy, 'ucb_baseline') and hasattr(policy, 'lcb_w'):
+            self.ucb_baseline = policy.ucb_baseline
+            self.lcb_w = policy.lcb_w
+        if hasattr(policy, 'schedule'):
+            self.schedule = policy.schedule.__deepcopy__()
+
+
+def incremental_evaluator(test_data, vali_indices, density=0.3, expected=False):
+    """
+    Returns an evaluation function with the signature of `evaluate_scored`
+    that keeps the scores of `vali_indices` in `ScoreTable`s between calls,
+    so that only the weight rows changed since the last call are applied.
+    It must always be called with the same data and rows.
+    """
+    ys = np.copy(test_data.ys[vali_indices])
+    tables = {}
+
+    def evaluate_fn(test_data, policy, vali_indices):
+        sampler = policy.baseline if hasattr(policy, 'baseline') else policy
+        if 'policy' not in tables:
+            tables['policy'] = ScoreTable(test_data.xs, vali_indices, policy.k, density)
+            if sampler is not policy:
+                tables['sampler'] = ScoreTable(test_data.xs, vali_indices, policy.k, density)
+        scores = tables['policy'].refresh(policy.w)
+        sampled = tables['sampler'].refresh(sampler.w) if 'sampler' in tables else scores
+        return _evaluate_tables(ys, sampler, scores, sampled, expected)
+
+    return evaluate_fn
+
+
+@numba.njit(nogil=True)
+def _evaluate_tables(ys, sampler, scores, sampled, expected):
+    cum_r_policy = 0.0
+    cum_r_best = 0.0
+    probs = np.empty(scores.shape[1])
+    for i in range(ys.shape[0]):
+        if expected:
+            cum_r_policy += sampler.score_probabilities(sampled[i], probs)[ys[i]]
+        else:
+            cum_r_policy += 1.0 if sampler.draw_scored(sampled[i]) == ys[i] else 0.0
+        cum_r_best += 1.0 if argmax(scores[i]) == ys[i] else 0.0
+    return cum_r_policy / ys.shape[0], cum_r_best / ys.shape[0]
+
+
+@numba.njit(nogil=True)
+def evaluate_statistical(test_data, policy, vali_indices, expected=False):
+    """
+    Block-wise version of `evaluate` for statistical (UCB/Thompson) policies,
+    scoring the means and confidence bounds of a block of rows at once.
+    """
+    probs = np.empty(policy.k)
+    cum_r_policy = 0.0
+    cum_r_best = 0.0
+    for start in range(0, len(vali_indices), _EVALUATION_BLOCK):
+        end = min(len(vali_indices), start + _EVALUATION_BLOCK)
+        rows = vali_indices[start:end]
+        means = csr_rows_dot(test_data.xs, rows, policy.w)
+        bounds = policy.bounds(test_data.xs, rows)
+        for b in range(end - start):
+            y = test_data.ys[rows[b]]
+            if expected:
+                cum_r_policy += policy.probability_scored(means[b], bounds[b], probs)[y]
+            else:
+                cum_r_policy += 1.0 if policy.draw_scored(means[b], bounds[b]) == y else 0.0
+            cum_r_best += 1.0 if argmax(means[b]) == y else 0.0
+    return cum_r_policy / len(vali_indices), cum_r_best / len(vali_indices)
@@ -1,7 +1,11 @@
 import numba
 import numpy as np
+from scipy.linalg import cho_factor, cho_solve
+from scipy.sparse import csr_matrix
 from experiments.classification import dataset
 from experiments.classification.util import reward
+from experiments.classification.policies.statistical import COVARIANCE_FULL, COVARIANCE_DIAG
+from experiments.sparse import to_scipy
 
 
 @numba.njit(nogil=True)
@@ -35,13 +39,72 @@ def optimize_supervised_ridge(train, indices, policy, epochs=1):
         policy.update_w(i)
 
 
+def fit_ridge(train, indices, policy):
+    """
+    Closed-form equivalent of `optimize_supervised_ridge` for one epoch.
+    Every context is added to all actions, so the covariance of each action
+    grows by the same sparse `X^T X` of the sample and only the reward
+    vectors `b` differ. In full mode the shared system is factorized once
+    and inverted once for all actions, rather than per action.
+    """
+    xs = to_scipy(train.xs)[indices]
+    n = xs.shape[0]
+    onehot = csr_matrix((np.ones(n), (np.arange(n), train.ys[indices])), shape=(n, policy.k))
+    policy.b[:, :] += (onehot.T @ xs).toarray()
+    if policy.covariance == COVARIANCE_FULL:
+        policy.A[:, :, :] += (xs.T @ xs).toarray()[np.newaxis, :, :]
+        identity = np.identity(policy.d)
+        factors = []
+        for a in range(policy.k):
+            # All actions share A unless the policy was already trained
+            factor, A_inv = next(((f, inv) for A, f, inv in factors if np.array_equal(A, policy.A[a])), (None, None))
+            if factor is None:
+                factor = cho_factor(policy.A[a])
+                A_inv = cho_solve(factor, identity)
+                factors.append((policy.A[a], factor, A_inv))
+            policy.A_inv[a, :, :] = A_inv
+            policy.w[:, a] = cho_solve(factor, policy.b[a])
+            policy.recompute[a] = True
+    elif policy.covariance == COVARIANCE_DIAG:
+        policy.D[:, :] += np.asarray(xs.multiply(xs).sum(axis=0))
+        policy.w[:, :] = (policy.b / policy.D).T
+    else:
+        # Only the last `rank` contexts stay in U, everything inserted before
+        # them ends up folded into the diagonal.
+        head = max(0, n - policy.rank)
+        if head > 0:
+            _lowrank_fold(policy)
+            policy.D[:, :] += np.asarray(xs[:head].multiply(xs[:head]).sum(axis=0))
+            policy.slot[:] += head
+        _lowrank_insert_rows(train, indices[head:], policy)
+    policy.t += n * policy.k
+
+
+@numba.njit(nogil=True)
+def _lowrank_fold(policy):
+    for a in range(policy.k):
+        for s in range(policy.rank):
+            policy._lowrank_evict(a, s)
+        policy.M[a, :, :] = np.identity(policy.rank)
+
+
+@numba.njit(nogil=True)
+def _lowrank_insert_rows(train, indices, policy):
+    for i in indices:
+        x, _ = train.get(i)
+        for a in range(policy.k):
+            policy._lowrank_insert(x, a)
+    for a in range(policy.k):
+        policy._lowrank_solve(a)
+
+
 @numba.njit(nogil=True)
 def optimize(train, train_indices, vali_indices, policy):
     train_regret = 0.0
     vali_regret = 0.0
     for i in range(len(train_indices)):
         x, y = train.get(train_indices[i])
-        a = policy.draw(x)
+        a, p, s = policy.draw_with_propensity(x, train_indices[i])
         r = reward(x, y, a)
         train_regret += (1.0 - r)
 
@@ -54,6 +117,40 @@ def optimize(train, train_indices, vali_indices, policy):
 
         vali_regret += (1.0 - r_vali)
 
-        policy.update(train, train_indices[i], a, r)
+        policy.update_with_propensity(train, train_indices[i], a, r, p, s)
+
+    return train_regret, vali_regret
+
+
+@numba.njit(nogil=True)
+def optimize_batch(train, train_indices, vali_indices, policy, batch):
+    train_regret = 0.0
+    vali_regret = 0.0
+    for start in range(0, len(train_indices), batch):
+        end = min(len(train_indices), start + batch)
+        actions = np.empty(end - start, dtype=np.int64)
+        rewards = np.empty(end - start)
+        propensities = np.empty(end - start)
+        for b in range(end - start):
+            i = start + b
+            x, y = train.get(train_indices[i])
+            a, p, _ = policy.draw_with_propensity(x, train_indices[i])
+            r = reward(x, y, a)
+            train_regret += (1.0 - r)
+
+            if vali_indices[i] != train_indices[i]:
+                x_vali, y_vali = train.get(vali_indices[i])
+                a_vali = policy.draw(x_vali)
+                r_vali = reward(x_vali, y_vali, a_vali)
+            else:
+                r_vali = r
+
+            vali_regret += (1.0 - r_vali)
+
+            actions[b] = a
+            rewards[b] = r
+            propensities[b] = p
+
+        policy.update_batch(train, train_indices[start:end], actions, rewards, propensities)
 
     return train_regret, vali_regret
@@ -6,7 +6,9 @@ from experiments.classification.policies.uniform import UniformPolicy
 from experiments.classification.policies.ips import IPSPolicy
 from experiments.classification.policies.sea import SEAPolicy
 from experiments.classification.policies.comp import CompPolicy
-from experiments.classification.policies.statistical import StatisticalPolicy, TYPE_UCB as _TYPE_UCB, TYPE_THOMPSON as _TYPE_THOMPSON
+from experiments.classification.policies.schedule import BoundSchedule, create_schedule
+from experiments.classification.policies.cache import ProbabilityCache
+from experiments.classification.policies.statistical import StatisticalPolicy, TYPE_UCB as _TYPE_UCB, TYPE_THOMPSON as _TYPE_THOMPSON, TYPE_THOMPSON_WEIGHTS as _TYPE_THOMPSON_WEIGHTS, COVARIANCE_TYPES as _COVARIANCE_TYPES
 
 
 _STRATEGY_MAP = {
@@ -14,13 +16,24 @@ _STRATEGY_MAP = {
     'epsgreedy': lambda k, d, args: EpsgreedyPolicy(k, d, args['lr'], args['l2'], args['eps'], args['w']),
     'greedy': lambda k, d, args: GreedyPolicy(k, d, args['lr'], args['l2'], args['w']),
     'uniform': lambda k, d, args: UniformPolicy(k, d, args['lr'], args['l2'], args['w']),
-    'ips': lambda k, d, args: IPSPolicy(k, d, args['baseline'], args['lr'], args['l2'], args['cap'], args['w']),
-    'ucb': lambda k, d, args: StatisticalPolicy(k, d, args['l2'], args['alpha'], args['w'], draw_type=_TYPE_UCB),
-    'thompson': lambda k, d, args: StatisticalPolicy(k, d, args['l2'], args['alpha'], args['w'], draw_type=_TYPE_THOMPSON),
-    'sea': lambda k, d, args: SEAPolicy(k, d, args['n'], args['baseline'], args['lr'], args['l2'], args['cap'], args['w'], args['confidence'], recompute_bounds=args['recompute_bounds']),
-    'comp': lambda k, d, args: CompPolicy(k, d, args['n'], args['baseline'], args['lr'], args['l2'], args['cap'], args['w'], args['confidence'], recompute_bounds=args['recompute_bounds']),
+    'ips': lambda k, d, args: IPSPolicy(k, d, args['baseline'], args['lr'], args['l2'], args['cap'], args['w'], cache=_cache(k, args)),
+    'ucb': lambda k, d, args: StatisticalPolicy(k, d, args['l2'], args['alpha'], args['w'], draw_type=_TYPE_UCB, covariance=_COVARIANCE_TYPES[args['covariance']], rank=args['rank']),
+    'thompson': lambda k, d, args: StatisticalPolicy(k, d, args['l2'], args['alpha'], args['w'], draw_type=_TYPE_THOMPSON, covariance=_COVARIANCE_TYPES[args['covariance']], rank=args['rank'], samples=args['thompson_samples']),
+    'thompson_weights': lambda k, d, args: StatisticalPolicy(k, d, args['l2'], args['alpha'], args['w'], draw_type=_TYPE_THOMPSON_WEIGHTS, covariance=_COVARIANCE_TYPES[args['covariance']], rank=args['rank'], samples=args['thompson_samples']),
+    'sea': lambda k, d, args: SEAPolicy(k, d, args['n'], args['baseline'], args['lr'], args['l2'], args['cap'], args['w'], args['confidence'], schedule=_schedule(args), blocks=args['parallel_blocks'], cache=_cache(k, args)),
+    'comp': lambda k, d, args: CompPolicy(k, d, args['n'], args['baseline'], args['lr'], args['l2'], args['cap'], args['w'], args['confidence'], schedule=_schedule(args), blocks=args['parallel_blocks'], cache=_cache(k, args)),
 }
 
+
+def _schedule(args):
+    return create_schedule(args['bounds_schedule'], args['recompute_bounds'], args['bounds_interval'],
+                           args['bounds_growth'], args['bounds_budget'])
+
+
+def _cache(k, args):
+    return ProbabilityCache(args['n'], k, enabled=args['baseline_cache'])
+
+
 def create_policy(strategy, k, d, **args):
     defaults = {
         'w': None,
@@ -31,7 +44,17 @@ def create_policy(strategy, k, d, **args):
         'cap': 0.05,
         'alpha': 1.0,
         'confidence': 0.95,
-        'recompute_bounds': _np.array([1], dtype=_np.int32)
+        'recompute_bounds': _np.array([1], dtype=_np.int32),
+        'parallel_blocks': 0,
+        'bounds_schedule': 'fixed',
+        'bounds_interval': 1000,
+        'bounds_growth': 2.0,
+        'bounds_budget': 0.1,
+        'baseline_cache': False,
+        'covariance': 'full',
+        'rank': 16,
+        'thompson_samples': 0,
+        'n': 0
     }
     defaults.update(args)
     return _STRATEGY_MAP[strategy](k, d, defaults)
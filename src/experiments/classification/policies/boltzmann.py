@@ -1,7 +1,7 @@
 import numpy as np
 import numba
-from experiments.classification.policies.util import init_weights, argmax
-from rulpy.math import log_softmax, grad_softmax, softmax
+from experiments.classification.policies.util import init_weights, argmax, softmax_into, log_softmax_into, log_sum_exp, gumbel_argmax, softmax_coefs, apply_batch_gradient
+from experiments.sparse import csr_rows_dot
 
 
 @numba.jitclass([
@@ -10,35 +10,53 @@ from rulpy.math import log_softmax, grad_softmax, softmax
     ('lr', numba.float64),
     ('l2', numba.float64),
     ('tau', numba.float64),
-    ('w', numba.float64[:,:])
+    ('w', numba.float64[:,:]),
+    ('scores', numba.float64[:]),
+    ('probs', numba.float64[:])
 ])
 class _BoltzmannPolicy:
-    def __init__(self, k, d, lr, l2, tau, w):
+    def __init__(self, k, d, lr, l2, tau, w, scores, probs):
         self.k = k
         self.d = d
         self.lr = lr
         self.l2 = l2
         self.tau = tau
         self.w = w
+        self.scores = scores
+        self.probs = probs
     
     def update(self, dataset, index, a, r):
-        x, _ = dataset.get(index)
-        s = x.dot(self.w)
-        sm = softmax(s / self.tau)
+        self._update(dataset, index, a, r, dataset.xs.row_dot_into(index, self.w, self.scores))
+
+    def update_with_propensity(self, dataset, index, a, r, p, s):
+        self._update(dataset, index, a, r, s)
+
+    def update_batch(self, dataset, indices, actions, rewards, propensities):
+        scores = csr_rows_dot(dataset.xs, indices, self.w)
+        coefs = softmax_coefs(scores, actions, -rewards, self.tau) # turn rewards into losses
+        apply_batch_gradient(self.w, dataset.xs, indices, actions, coefs, self.lr, self.l2, True)
+
+    def _update(self, dataset, index, a, r, s):
+        sm = softmax_into(s, self.tau, self.probs)
         loss = -r # turn reward into loss
-        for i in range(x.nnz):
-            col = x.indices[i]
-            val = x.data[i]
+        xs = dataset.xs
+        for i in range(xs.indptr[index], xs.indptr[index + 1]):
+            col = xs.indices[i]
+            val = xs.data[i]
             for aprime in range(self.k):
                 kronecker = 1.0 if aprime == a else 0.0
                 self.w[col, aprime] -= self.lr * ((val / self.tau) * loss * sm[aprime] * (kronecker - sm[a]) + self.l2 * self.w[col, aprime])
     
     def draw(self, x):
-        s = x.dot(self.w)
-        log_p = log_softmax(s / self.tau)
-        u = np.random.uniform(0.0, 1.0, s.shape)
-        r = np.log(-np.log(u)) - log_p
-        return argmax(-r)
+        return gumbel_argmax(x.dot(self.w), self.tau)
+
+    def draw_scored(self, s):
+        return gumbel_argmax(s, self.tau)
+
+    def draw_with_propensity(self, x, index):
+        s = x.dot_into(self.w, self.scores)
+        a = gumbel_argmax(s, self.tau)
+        return a, np.exp(s[a] / self.tau - log_sum_exp(s, self.tau)), s
     
     def max(self, x):
         s = x.dot(self.w)
@@ -46,11 +64,14 @@ class _BoltzmannPolicy:
     
     def probability(self, x, a):
         s = x.dot(self.w)
-        return softmax(s / self.tau)[a]
+        return softmax_into(s, self.tau, s)[a]
 
     def log_probability(self, x, a):
         s = x.dot(self.w)
-        return log_softmax(s / self.tau)[a]
+        return log_softmax_into(s, self.tau, s)[a]
+
+    def score_probabilities(self, s, out):
+        return softmax_into(s, self.tau, out)
 
 
 def __getstate(self):
@@ -83,7 +104,7 @@ def __deepcopy(self):
 
 def BoltzmannPolicy(k, d, lr=0.01, l2=0.0, tau=1.0, w=None, **kw_args):
     w = init_weights(k, d, w)
-    out = _BoltzmannPolicy(k, d, lr, l2, tau, w)
+    out = _BoltzmannPolicy(k, d, lr, l2, tau, w, np.zeros(k), np.zeros(k))
     setattr(out.__class__, '__getstate__', __getstate)
     setattr(out.__class__, '__setstate__', __setstate)
     setattr(out.__class__, '__reduce__', __reduce)
@@ -0,0 +1,98 @@
+import numpy as np
+import numba
+
+
+@numba.jitclass([
+    ('probs', numba.float32[:,:]),
+    ('valid', numba.boolean[:]),
+    ('enabled', numba.boolean),
+    ('hits', numba.int64),
+    ('misses', numba.int64)
+])
+class _ProbabilityCache:
+    """
+    Dense per-row cache of the action probabilities of a baseline policy on
+    the training set. Rows are filled on first use and stay valid until the
+    baseline changes, at which point `invalidate` has to be called. A
+    disabled cache passes all lookups through to the baseline.
+    """
+    def __init__(self, probs, valid, enabled, hits, misses):
+        self.probs = probs
+        self.valid = valid
+        self.enabled = enabled
+        self.hits = hits
+        self.misses = misses
+
+    def probability(self, baseline, x, index, a):
+        if not self.enabled:
+            return baseline.probability(x, a)
+        return self.probabilities(baseline, x, index)[a]
+
+    def probabilities(self, baseline, x, index):
+        if not self.valid[index]:
+            self.misses += 1
+            s = x.dot(baseline.w)
+            ps = baseline.score_probabilities(s, np.empty(s.shape[0]))
+            for j in range(ps.shape[0]):
+                self.probs[index, j] = ps[j]
+            self.valid[index] = True
+        else:
+            self.hits += 1
+        return self.probs[index]
+
+    def draw(self, baseline, x, index):
+        if not self.enabled:
+            a, p, _ = baseline.draw_with_propensity(x, index)
+            return a, p
+        ps = self.probabilities(baseline, x, index)
+        u = np.random.random() * np.sum(ps)
+        a = ps.shape[0] - 1
+        c = 0.0
+        for j in range(ps.shape[0]):
+            c += ps[j]
+            if u < c:
+                a = j
+                break
+        return a, float(ps[a])
+
+    def invalidate(self):
+        self.valid[:] = False
+
+
+def __getstate(self):
+    return {
+        'probs': self.probs,
+        'valid': self.valid,
+        'enabled': self.enabled,
+        'hits': self.hits,
+        'misses': self.misses
+    }
+
+
+def __setstate(self, state):
+    self.probs = state['probs']
+    self.valid = state['valid']
+    self.enabled = state['enabled']
+    self.hits = state['hits']
+    self.misses = state['misses']
+
+
+def __reduce(self):
+    return (ProbabilityCache, (0, 0), self.__getstate__())
+
+
+def __deepcopy(self):
+    return ProbabilityCache(self.probs.shape[0], self.probs.shape[1], self.enabled, np.copy(self.probs),
+                            np.copy(self.valid), self.hits, self.misses)
+
+
+def ProbabilityCache(n, k, enabled=True, probs=None, valid=None, hits=0, misses=0):
+    n = n if enabled else 0
+    probs = np.zeros((n, k), dtype=np.float32) if probs is None else probs
+    valid = np.zeros(n, dtype=np.bool_) if valid is None else valid
+    out = _ProbabilityCache(probs, valid, enabled, hits, misses)
+    setattr(out.__class__, '__getstate__', __getstate)
+    setattr(out.__class__, '__setstate__', __setstate)
+    setattr(out.__class__, '__reduce__', __reduce)
+    setattr(out.__class__, '__deepcopy__', __deepcopy)
+    return out
@@ -1,11 +1,13 @@
 import numpy as np
 import numba
-from experiments.classification.policies.util import init_weights, argmax
-from experiments.sparse import from_scipy, SparseVectorList
+from experiments.classification.policies.util import init_weights, argmax, softmax_into, softmax_coefs, apply_batch_gradient, bound_sums, bound_sums_parallel, rows_nnz
+from experiments.classification.policies.schedule import BoundSchedule
+from experiments.classification.policies.cache import ProbabilityCache
+from experiments.sparse import from_scipy, SparseVectorList, SparseAccumulator, csr_rows_dot
 from experiments.util import mpeb_bound
 from scipy.sparse import csr_matrix
 from rulpy.array import GrowingArray
-from rulpy.math import log_softmax, grad_softmax, softmax
+from rulpy.math import log_softmax, softmax
 from llvmlite import binding
 
 
@@ -15,6 +17,11 @@ from llvmlite import binding
 binding.set_option("tmp", "-non-global-value-max-name-size=4096")
 
 
+_sparse_accumulator = numba.typeof(SparseAccumulator((1, 1)))
+_bound_schedule = numba.typeof(BoundSchedule())
+_probability_cache = numba.typeof(ProbabilityCache(1, 1))
+
+
 _COMP_POLICY_TYPE_CACHE = {}
 
 
@@ -29,9 +36,11 @@ def _CompPolicy(bl_type):
         ('baseline', bl_type),
         ('w', numba.float64[:,:]),
         ('confidence', numba.float64),
-        ('ips_w', numba.float64[:,:]),
-        ('ips_w2', numba.float64[:,:]),
+        ('ips', _sparse_accumulator),
         ('ips_n', numba.int64),
+        ('baseline_sum_mean', numba.float64),
+        ('baseline_sum_var', numba.float64),
+        ('baseline_max', numba.float64),
         # ('history', numba.types.Tuple([
         #    numba.typeof(GrowingArray(dtype=numba.int32)),   # vectors
         #    numba.typeof(GrowingArray(dtype=numba.int32)),   # actions
@@ -40,11 +49,15 @@ def _CompPolicy(bl_type):
         # ])),
         ('ucb_baseline', numba.float64),
         ('lcb_w', numba.float64),
-        ('recompute_bounds', numba.int32[:]),
-        ('t', numba.int32)
+        ('schedule', _bound_schedule),
+        ('t', numba.int32),
+        ('blocks', numba.int32),
+        ('cache', _probability_cache),
+        ('scores', numba.float64[:]),
+        ('probs', numba.float64[:])
     ])
     class CompPolicy:
-        def __init__(self, k, d, n, lr, l2, cap, baseline, w, confidence, ips_w, ips_w2, ips_n, ucb_baseline, lcb_w, recompute_bounds, t):
+        def __init__(self, k, d, n, lr, l2, cap, baseline, w, confidence, ips, ips_n, baseline_sum_mean, baseline_sum_var, baseline_max, ucb_baseline, lcb_w, schedule, t, blocks, cache, scores, probs):
             self.k = k
             self.d = d
             self.n = n
@@ -55,44 +68,85 @@ def _CompPolicy(bl_type):
             self.w = w
             self.confidence = confidence
             # self.history = history
-            self.ips_w = ips_w
-            self.ips_w2 = ips_w2
+            self.ips = ips
             self.ips_n = ips_n
+            self.baseline_sum_mean = baseline_sum_mean
+            self.baseline_sum_var = baseline_sum_var
+            self.baseline_max = baseline_max
             self.ucb_baseline = ucb_baseline
             self.lcb_w = lcb_w
-            self.recompute_bounds = recompute_bounds
+            self.schedule = schedule
             self.t = t
+            self.blocks = blocks
+            self.cache = cache
+            self.scores = scores
+            self.probs = probs
 
         def update(self, dataset, index, a, r):
             x, _ = dataset.get(index)
-            p = max(self.cap, self.probability(x, a))
-            s = x.dot(self.w)
-            sm = softmax(s / self.baseline.tau)
-            #sma = softmax(s / self.baseline.tau)[a]
-            g = grad_softmax(s)
+            self._update(dataset, index, a, r, self.cache.probability(self.baseline, x, index, a), x.dot_into(self.w, self.scores))
+
+        def update_with_propensity(self, dataset, index, a, r, p, s):
+            self._update(dataset, index, a, r, p, s)
+
+        def update_batch(self, dataset, indices, actions, rewards, propensities):
+            losses = np.empty(indices.shape[0])
+            for b in range(indices.shape[0]):
+                losses[b] = ((1.0 - rewards[b]) - 0.8) / max(self.cap, propensities[b]) # lambda-ips loss
+            scores = csr_rows_dot(dataset.xs, indices, self.w)
+            coefs = softmax_coefs(scores, actions, losses, self.baseline.tau)
+            xs = dataset.xs
+            apply_batch_gradient(self.w, xs, indices, actions, coefs, self.lr, self.l2, True)
+            due = False
+            for b in range(indices.shape[0]):
+                index = indices[b]
+                self._record_history(index, actions[b], rewards[b], max(self.cap, propensities[b]), propensities[b])
+                self.t += 1
+                self.schedule.record_update((xs.indptr[index + 1] - xs.indptr[index]) * self.k)
+                due = self.schedule.due(self.t) or due
+            if self.ips_n >= 1 and due:
+                swap_sums = self._recompute_bounds(dataset)
+                self._update_baseline(swap_sums)
+
+        def _update(self, dataset, index, a, r, baseline_p, s):
+            p = max(self.cap, baseline_p)
+            sm = softmax_into(s, self.baseline.tau, self.probs)
             loss = ((1.0 -r) - 0.8) / p # lambda-ips loss
-            for i in range(x.nnz):
-                col = x.indices[i]
-                val = x.data[i]
+            xs = dataset.xs
+            for i in range(xs.indptr[index], xs.indptr[index + 1]):
+                col = xs.indices[i]
+                val = xs.data[i]
                 for aprime in range(self.k):
                     kronecker = 1.0 if aprime == a else 0.0
                     self.w[col, aprime] -= self.lr * ((val / self.baseline.tau) * loss * sm[aprime] * (kronecker - sm[a]) + self.l2 * self.w[col, aprime])
-            self._record_history(index, a, r, p)
+            self._record_history(index, a, r, p, baseline_p)
             self.t += 1
-            if self.ips_n >= 1 and (len(np.where(self.t == self.recompute_bounds)[0]) == 1 or self.t % 1000 == 0):
-                self._recompute_bounds(dataset)
-                self._update_baseline()
+            self.schedule.record_update((xs.indptr[index + 1] - xs.indptr[index]) * self.k)
+            if self.ips_n >= 1 and self.schedule.due(self.t):
+                swap_sums = self._recompute_bounds(dataset)
+                self._update_baseline(swap_sums)
 
-        def _record_history(self, index, a, r, p):
+        def _record_history(self, index, a, r, p, baseline_p):
             # self.history[0].append(index)
             # self.history[1].append(a)
             # self.history[2].append(r)
             # self.history[3].append(p)
-            self.ips_w[index, a] += r / p
-            self.ips_w2[index, a] += (r / p) ** 2
+            v = r / p
+            self.ips.add(index, a, v)
             self.ips_n += 1
-
-        def _update_baseline(self):
+            if v != 0.0:
+                self.baseline_sum_mean += baseline_p * v
+                self.baseline_sum_var += baseline_p**2 * v**2
+                self.baseline_max = max(self.baseline_max, baseline_p * self.ips.get(index, a))
+            self._update_ucb_baseline()
+
+        def _update_ucb_baseline(self):
+            if self.ips_n >= 1:
+                baseline_mean = self.baseline_sum_mean / self.ips_n
+                baseline_var = (self.baseline_sum_var / self.ips_n) - (baseline_mean ** 2)
+                self.ucb_baseline = baseline_mean #+ mpeb_bound(self.ips_n, self.confidence, baseline_var, self.baseline_max)
+
+        def _update_baseline(self, swap_sums):
             if self.lcb_w > self.ucb_baseline:
                 # replace baseline with a deepcopy of learned model
                 # e.g.  `with objmode(y='intp[:]'):`
@@ -100,35 +154,26 @@ def _CompPolicy(bl_type):
                 # to support this we should supported weighted updates
                 # and make learning of the new policy as a separate policy
                 self.baseline.w = np.copy(self.w)
+                self.cache.invalidate()
+                # The running baseline sums are only valid for the baseline
+                # they were logged under, the sums for the swapped baseline
+                # come from the same pass that computed the new bounds.
+                self.baseline_sum_mean, self.baseline_sum_var, self.baseline_max = swap_sums
+                self._update_ucb_baseline()
 
         def _recompute_bounds(self, dataset):
-            new_sum_mean = 0.0
-            new_sum_var = 0.0
-            baseline_sum_mean = 0.0
-            baseline_sum_var = 0.0
-            new_max = 0.0
-            baseline_max = 0.0
-            for index in range(self.n):
-                for a in range(self.k):
-                    if self.ips_w[index, a] != 0.0:
-                        x, _ = dataset.get(index)
-                        s = x.dot(self.w)
-                        new_p = softmax(s / self.baseline.tau)[a]
-                        baseline_p = self.baseline.probability(x, a)
-                        new_sum_mean += new_p * self.ips_w[index, a]
-                        new_sum_var += new_p**2 * self.ips_w2[index, a]
-                        baseline_sum_mean += baseline_p * self.ips_w[index, a]
-                        baseline_sum_var += baseline_p**2 * self.ips_w2[index, a]
-                        new_max = max(new_max, new_p * self.ips_w[index, a])
-                        baseline_max = max(baseline_max, baseline_p * self.ips_w[index, a])
+            if self.blocks > 0:
+                new_sum_mean, new_sum_var, new_max, swap_sum_mean, swap_sum_var, swap_max = bound_sums_parallel(
+                    dataset.xs, self.ips, self.w, self.baseline.tau, self.baseline, self.blocks)
+            else:
+                new_sum_mean, new_sum_var, new_max, swap_sum_mean, swap_sum_var, swap_max = bound_sums(
+                    dataset.xs, self.ips, self.w, self.baseline.tau, self.baseline)
+            self.schedule.record_bounds(self.t, self.k * rows_nnz(dataset.xs, self.ips.rows[:self.ips.n_rows]) + self.ips.nnz)
             new_mean = new_sum_mean / self.ips_n
-            baseline_mean = baseline_sum_mean / self.ips_n
-
             new_var = (new_sum_var / self.ips_n) - (new_mean ** 2)
-            baseline_var = (baseline_sum_var / self.ips_n) - (baseline_mean ** 2)
 
-            self.ucb_baseline = baseline_mean #+ mpeb_bound(self.ips_n, self.confidence, baseline_var, baseline_max)
             self.lcb_w = new_mean #- mpeb_bound(self.ips_n, self.confidence, new_var, new_max)
+            return swap_sum_mean, swap_sum_var, swap_max
 
             # n = self.history[1].size
 
@@ -157,6 +202,10 @@ def _CompPolicy(bl_type):
         def draw(self, x):
             return self.baseline.draw(x)
 
+        def draw_with_propensity(self, x, index):
+            a, p = self.cache.draw(self.baseline, x, index)
+            return a, p, x.dot_into(self.w, self.scores)
+
         def max(self, x):
             s = x.dot(self.w)
             # log_p = log_softmax(s)
@@ -188,13 +237,17 @@ def __getstate(self):
         #     self.history[2],
         #     self.history[3]
         # ),
-        'ips_w': self.ips_w,
-        'ips_w2': self.ips_w2,
+        'ips': self.ips,
         'ips_n': self.ips_n,
+        'baseline_sum_mean': self.baseline_sum_mean,
+        'baseline_sum_var': self.baseline_sum_var,
+        'baseline_max': self.baseline_max,
         'ucb_baseline': self.ucb_baseline,
         'lcb_w': self.lcb_w,
-        'recompute_bounds': self.recompute_bounds,
-        't': self.t
+        'schedule': self.schedule,
+        't': self.t,
+        'blocks': self.blocks,
+        'cache': self.cache
     }
 
 
@@ -209,13 +262,17 @@ def __setstate(self, state):
     self.w = state['w']
     self.confidence = state['confidence']
     #self.history = state['history']
-    self.ips_w = state['ips_w']
-    self.ips_w2 = state['ips_w2']
+    self.ips = state['ips']
     self.ips_n = state['ips_n']
+    self.baseline_sum_mean = state['baseline_sum_mean']
+    self.baseline_sum_var = state['baseline_sum_var']
+    self.baseline_max = state['baseline_max']
     self.ucb_baseline = state['ucb_baseline']
     self.lcb_w = state['lcb_w']
-    self.recompute_bounds = state['recompute_bounds']
+    self.schedule = state['schedule']
     self.t = state['t']
+    self.blocks = state['blocks']
+    self.cache = state['cache']
 
 
 def __reduce(self):
@@ -230,10 +287,12 @@ def __deepcopy(self):
                     #      self.history[2].__deepcopy__(),
                     #      self.history[3].__deepcopy__()
                     #  ),
-                    np.copy(self.ips_w), np.copy(self.ips_w2), self.ips_n, self.ucb_baseline, self.lcb_w, self.recompute_bounds, self.t)
+                    self.ips.__deepcopy__(), self.ips_n,
+                    self.baseline_sum_mean, self.baseline_sum_var, self.baseline_max, self.ucb_baseline, self.lcb_w, self.schedule.__deepcopy__(), self.t, self.blocks,
+                    self.cache.__deepcopy__())
 
 
-def CompPolicy(k, d, n, baseline, lr=0.01, l2=0.0, cap=0.05, w=None, confidence=0.95, ips_w=None, ips_w2=None, ips_n=0, ucb_baseline=0.0, lcb_w=0.0, recompute_bounds=None, t=0, **kw_args):
+def CompPolicy(k, d, n, baseline, lr=0.01, l2=0.0, cap=0.05, w=None, confidence=0.95, ips=None, ips_n=0, baseline_sum_mean=0.0, baseline_sum_var=0.0, baseline_max=0.0, ucb_baseline=0.0, lcb_w=0.0, schedule=None, t=0, blocks=0, cache=None, **kw_args):
     w = init_weights(k, d, w)
     bl_type = numba.typeof(baseline)
     if bl_type not in _COMP_POLICY_TYPE_CACHE:
@@ -244,10 +303,10 @@ def CompPolicy(k, d, n, baseline, lr=0.01, l2=0.0, cap=0.05, w=None, confidence=
     #     GrowingArray(dtype=numba.float64),
     #     GrowingArray(dtype=numba.float64)
     # ) if history is None else history
-    ips_w = np.zeros((n, k)) if ips_w is None else ips_w
-    ips_w2 = np.zeros((n, k)) if ips_w2 is None else ips_w2
-    recompute_bounds = np.array([1], dtype=np.int32) if recompute_bounds is None else recompute_bounds
-    out = _COMP_POLICY_TYPE_CACHE[bl_type](k, d, n, lr, l2, cap, baseline, w, confidence, ips_w, ips_w2, ips_n, ucb_baseline, lcb_w, recompute_bounds, t)
+    ips = SparseAccumulator((n, k)) if ips is None else ips
+    schedule = BoundSchedule() if schedule is None else schedule
+    cache = ProbabilityCache(0, k, enabled=False) if cache is None else cache
+    out = _COMP_POLICY_TYPE_CACHE[bl_type](k, d, n, lr, l2, cap, baseline, w, confidence, ips, ips_n, baseline_sum_mean, baseline_sum_var, baseline_max, ucb_baseline, lcb_w, schedule, t, blocks, cache, np.zeros(k), np.zeros(k))
     setattr(out.__class__, '__getstate__', __getstate)
     setattr(out.__class__, '__setstate__', __setstate)
     setattr(out.__class__, '__reduce__', __reduce)
@@ -1,6 +1,7 @@
 import numpy as np
 import numba
-from experiments.classification.policies.util import argmax, init_weights
+from experiments.sparse import csr_rows_dot
+from experiments.classification.policies.util import argmax, init_weights, apply_batch_gradient, greedy_into
 from experiments.classification.policies.greedy import GreedyPolicy
 from experiments.classification.policies.uniform import UniformPolicy
 
@@ -24,7 +25,20 @@ class _EpsgreedyPolicy:
     
     def update(self, dataset, index, a, r):
         x, _ = dataset.get(index)
-        s = x.dot(self.w[:, a])
+        self._update(x, a, r, x.dot(self.w[:, a]))
+
+    def update_with_propensity(self, dataset, index, a, r, p, s):
+        x, _ = dataset.get(index)
+        self._update(x, a, r, s[a])
+
+    def update_batch(self, dataset, indices, actions, rewards, propensities):
+        scores = csr_rows_dot(dataset.xs, indices, self.w)
+        coefs = np.zeros_like(scores)
+        for b in range(indices.shape[0]):
+            coefs[b, actions[b]] = scores[b, actions[b]] - rewards[b] # square loss
+        apply_batch_gradient(self.w, dataset.xs, indices, actions, coefs, self.lr, self.l2, False)
+
+    def _update(self, x, a, r, s):
         loss = s - r # square loss reward compared to score (predicted reward)
         for i in range(x.nnz):
             col = x.indices[i]
@@ -36,7 +50,23 @@ class _EpsgreedyPolicy:
             return np.random.randint(self.k)
         else:
             return self.max(x)
+
+    def draw_scored(self, s):
+        if np.random.random() < self.eps:
+            return np.random.randint(self.k)
+        else:
+            return argmax(s)
     
+    def draw_with_propensity(self, x, index):
+        s = x.dot(self.w)
+        if np.random.random() < self.eps:
+            a = np.random.randint(self.k)
+        else:
+            a = argmax(s)
+        m = np.max(s)
+        gp = 1.0 * (s[a] == m) / np.sum(s == m)
+        return a, (self.eps) * (1.0 / float(self.k)) + (1 - self.eps) * gp, s
+
     def max(self, x):
         return argmax(x.dot(self.w))
     
@@ -49,6 +79,13 @@ class _EpsgreedyPolicy:
         gp = gp[a]
         return (self.eps) * up + (1 - self.eps) * gp
 
+    def score_probabilities(self, s, out):
+        greedy_into(s, out)
+        up = 1.0 / float(self.k)
+        for j in range(s.shape[0]):
+            out[j] = (self.eps) * up + (1 - self.eps) * out[j]
+        return out
+
 
 def __getstate(self):
     return {
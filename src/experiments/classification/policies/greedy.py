@@ -1,6 +1,7 @@
 import numpy as np
 import numba
-from experiments.classification.policies.util import argmax, init_weights
+from experiments.sparse import csr_rows_dot
+from experiments.classification.policies.util import argmax, init_weights, apply_batch_gradient, greedy_into
 
 
 @numba.jitclass([
@@ -20,7 +21,20 @@ class _GreedyPolicy:
     
     def update(self, dataset, index, a, r):
         x, _ = dataset.get(index)
-        s = x.dot(self.w[:, a])
+        self._update(x, a, r, x.dot(self.w[:, a]))
+
+    def update_with_propensity(self, dataset, index, a, r, p, s):
+        x, _ = dataset.get(index)
+        self._update(x, a, r, s[a])
+
+    def update_batch(self, dataset, indices, actions, rewards, propensities):
+        scores = csr_rows_dot(dataset.xs, indices, self.w)
+        coefs = np.zeros_like(scores)
+        for b in range(indices.shape[0]):
+            coefs[b, actions[b]] = scores[b, actions[b]] - rewards[b] # square loss
+        apply_batch_gradient(self.w, dataset.xs, indices, actions, coefs, self.lr, self.l2, False)
+
+    def _update(self, x, a, r, s):
         loss = s - r # square loss reward compared to score (predicted reward)
         for i in range(x.nnz):
             col = x.indices[i]
@@ -29,7 +43,15 @@ class _GreedyPolicy:
     
     def draw(self, x):
         return self.max(x)
+
+    def draw_scored(self, s):
+        return argmax(s)
     
+    def draw_with_propensity(self, x, index):
+        s = x.dot(self.w)
+        a = argmax(s)
+        return a, 1.0 / np.sum(s == s[a]), s
+
     def max(self, x):
         return argmax(x.dot(self.w))
     
@@ -40,6 +62,9 @@ class _GreedyPolicy:
         p /= np.sum(p)
         return p[a]
 
+    def score_probabilities(self, s, out):
+        return greedy_into(s, out)
+
 
 def __getstate(self):
     return {
@@ -1,9 +1,14 @@
 import numpy as np
 import numba
-from experiments.classification.policies.util import init_weights, argmax
+from experiments.classification.policies.util import init_weights, argmax, softmax_into, softmax_coefs, apply_batch_gradient
+from experiments.sparse import csr_rows_dot
+from experiments.classification.policies.cache import ProbabilityCache
 from rulpy.math import softmax, grad_softmax, log_softmax, grad_log_softmax
 
 
+_probability_cache = numba.typeof(ProbabilityCache(1, 1))
+
+
 _IPS_POLICY_TYPE_CACHE = {}
 
 def _IPSPolicy(bl_type):
@@ -14,10 +19,13 @@ def _IPSPolicy(bl_type):
         ('l2', numba.float64),
         ('cap', numba.float64),
         ('baseline', bl_type),
-        ('w', numba.float64[:,:])
+        ('w', numba.float64[:,:]),
+        ('cache', _probability_cache),
+        ('scores', numba.float64[:]),
+        ('probs', numba.float64[:])
     ])
     class IPSPolicy:
-        def __init__(self, k, d, lr, l2, cap, baseline, w):
+        def __init__(self, k, d, lr, l2, cap, baseline, w, cache, scores, probs):
             self.k = k
             self.d = d
             self.lr = lr
@@ -25,16 +33,33 @@ def _IPSPolicy(bl_type):
             self.cap = cap
             self.baseline = baseline
             self.w = w
+            self.cache = cache
+            self.scores = scores
+            self.probs = probs
         
         def update(self, dataset, index, a, r):
             x, _ = dataset.get(index)
-            p = max(self.cap, self.probability(x, a))
-            s = x.dot(self.w)
-            sm = softmax(s / self.baseline.tau)
+            self._update(dataset, index, a, r, self.cache.probability(self.baseline, x, index, a), x.dot_into(self.w, self.scores))
+
+        def update_with_propensity(self, dataset, index, a, r, p, s):
+            self._update(dataset, index, a, r, p, s)
+
+        def update_batch(self, dataset, indices, actions, rewards, propensities):
+            losses = np.empty(indices.shape[0])
+            for b in range(indices.shape[0]):
+                losses[b] = ((1.0 - rewards[b]) - 0.8) / max(self.cap, propensities[b]) # lambda-ips loss
+            scores = csr_rows_dot(dataset.xs, indices, self.w)
+            coefs = softmax_coefs(scores, actions, losses, self.baseline.tau)
+            apply_batch_gradient(self.w, dataset.xs, indices, actions, coefs, self.lr, self.l2, True)
+
+        def _update(self, dataset, index, a, r, p, s):
+            p = max(self.cap, p)
+            sm = softmax_into(s, self.baseline.tau, self.probs)
             loss = ((1.0 -r) - 0.8) / p # lambda-ips loss
-            for i in range(x.nnz):
-                col = x.indices[i]
-                val = x.data[i]
+            xs = dataset.xs
+            for i in range(xs.indptr[index], xs.indptr[index + 1]):
+                col = xs.indices[i]
+                val = xs.data[i]
                 for aprime in range(self.k):
                     kronecker = 1.0 if aprime == a else 0.0
                     self.w[col, aprime] -= self.lr * ((val / self.baseline.tau) * loss * sm[aprime] * (kronecker - sm[a]) + self.l2 * self.w[col, aprime])
@@ -48,6 +73,10 @@ def _IPSPolicy(bl_type):
         
         def draw(self, x):
             return self.baseline.draw(x)
+
+        def draw_with_propensity(self, x, index):
+            a, p = self.cache.draw(self.baseline, x, index)
+            return a, p, x.dot_into(self.w, self.scores)
         
         def max(self, x):
             s = x.dot(self.w)
@@ -67,7 +96,8 @@ def __getstate(self):
         'l2': self.l2,
         'cap': self.cap,
         'baseline': self.baseline,
-        'w': self.w
+        'w': self.w,
+        'cache': self.cache
     }
 
 
@@ -79,6 +109,7 @@ def __setstate(self, state):
     self.cap = state['cap']
     self.baseline = state['baseline']
     self.w = state['w']
+    self.cache = state['cache']
 
 
 def __reduce(self):
@@ -86,15 +117,16 @@ def __reduce(self):
 
 
 def __deepcopy(self):
-    return IPSPolicy(self.k, self.d, self.baseline.__deepcopy__(), self.lr, self.l2, self.cap, np.copy(self.w))
+    return IPSPolicy(self.k, self.d, self.baseline.__deepcopy__(), self.lr, self.l2, self.cap, np.copy(self.w), self.cache.__deepcopy__())
 
 
-def IPSPolicy(k, d, baseline, lr=0.01, l2=0.0, cap=0.05, w=None, **kw_args):
+def IPSPolicy(k, d, baseline, lr=0.01, l2=0.0, cap=0.05, w=None, cache=None, **kw_args):
     w = init_weights(k, d, w)
     bl_type = numba.typeof(baseline)
     if bl_type not in _IPS_POLICY_TYPE_CACHE:
         _IPS_POLICY_TYPE_CACHE[bl_type] = _IPSPolicy(bl_type)
-    out = _IPS_POLICY_TYPE_CACHE[bl_type](k, d, lr, l2, cap, baseline, w)
+    cache = ProbabilityCache(0, k, enabled=False) if cache is None else cache
+    out = _IPS_POLICY_TYPE_CACHE[bl_type](k, d, lr, l2, cap, baseline, w, cache, np.zeros(k), np.zeros(k))
     setattr(out.__class__, '__getstate__', __getstate)
     setattr(out.__class__, '__setstate__', __setstate)
     setattr(out.__class__, '__reduce__', __reduce)
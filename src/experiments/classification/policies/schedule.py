@@ -0,0 +1,135 @@
+import numpy as np
+import numba
+
+
+SCHEDULE_FIXED = 0
+SCHEDULE_GEOMETRIC = 1
+SCHEDULE_BUDGET = 2
+
+
+_SCHEDULE_KINDS = {
+    'fixed': SCHEDULE_FIXED,
+    'geometric': SCHEDULE_GEOMETRIC,
+    'budget': SCHEDULE_BUDGET
+}
+
+
+@numba.jitclass([
+    ('kind', numba.int32),
+    ('points', numba.int32[:]),
+    ('cursor', numba.int64),
+    ('interval', numba.int64),
+    ('growth', numba.float64),
+    ('budget', numba.float64),
+    ('next_t', numba.int64),
+    ('update_cost', numba.float64),
+    ('bounds_cost', numba.float64),
+    ('last_cost', numba.float64),
+    ('recomputes', numba.int64)
+])
+class _BoundSchedule:
+    """
+    Decides at which steps the SEA/Comp bounds are recomputed. The bounds are
+    always recomputed at the (sorted) evaluation `points`, in between the
+    `kind` decides:
+
+      fixed:     every `interval` steps.
+      geometric: at steps that grow by a factor `growth` after every
+                 recompute.
+      budget:    whenever the next recompute keeps the share of work spent
+                 on bounds below `budget`.
+
+    Costs are counted in multiply-adds rather than wall time, so schedules
+    are reproducible for a fixed seed.
+    """
+    def __init__(self, kind, points, cursor, interval, growth, budget, next_t, update_cost, bounds_cost, last_cost, recomputes):
+        self.kind = kind
+        self.points = points
+        self.cursor = cursor
+        self.interval = interval
+        self.growth = growth
+        self.budget = budget
+        self.next_t = next_t
+        self.update_cost = update_cost
+        self.bounds_cost = bounds_cost
+        self.last_cost = last_cost
+        self.recomputes = recomputes
+
+    def due(self, t):
+        while self.cursor < self.points.shape[0] and self.points[self.cursor] < t:
+            self.cursor += 1
+        if self.cursor < self.points.shape[0] and self.points[self.cursor] == t:
+            return True
+        if self.kind == SCHEDULE_FIXED:
+            return t % self.interval == 0
+        elif self.kind == SCHEDULE_GEOMETRIC:
+            return t >= self.next_t
+        elif self.kind == SCHEDULE_BUDGET:
+            spent = self.bounds_cost + self.last_cost
+            return spent <= self.budget * (spent + self.update_cost)
+        else:
+            raise ValueError("Unknown schedule kind")
+
+    def record_update(self, cost):
+        self.update_cost += cost
+
+    def record_bounds(self, t, cost):
+        self.recomputes += 1
+        self.bounds_cost += cost
+        self.last_cost = cost
+        self.next_t = max(t + 1, int(np.ceil(t * self.growth)))
+
+
+def __getstate(self):
+    return {
+        'kind': self.kind,
+        'points': self.points,
+        'cursor': self.cursor,
+        'interval': self.interval,
+        'growth': self.growth,
+        'budget': self.budget,
+        'next_t': self.next_t,
+        'update_cost': self.update_cost,
+        'bounds_cost': self.bounds_cost,
+        'last_cost': self.last_cost,
+        'recomputes': self.recomputes
+    }
+
+
+def __setstate(self, state):
+    self.kind = state['kind']
+    self.points = state['points']
+    self.cursor = state['cursor']
+    self.interval = state['interval']
+    self.growth = state['growth']
+    self.budget = state['budget']
+    self.next_t = state['next_t']
+    self.update_cost = state['update_cost']
+    self.bounds_cost = state['bounds_cost']
+    self.last_cost = state['last_cost']
+    self.recomputes = state['recomputes']
+
+
+def __reduce(self):
+    return (BoundSchedule, (self.points,), self.__getstate__())
+
+
+def __deepcopy(self):
+    return BoundSchedule(np.copy(self.points), self.kind, self.interval, self.growth, self.budget,
+                         self.cursor, self.next_t, self.update_cost, self.bounds_cost,
+                         self.last_cost, self.recomputes)
+
+
+def BoundSchedule(points=None, kind=SCHEDULE_FIXED, interval=1000, growth=2.0, budget=0.1, cursor=0,
+                  next_t=0, update_cost=0.0, bounds_cost=0.0, last_cost=0.0, recomputes=0, **kw_args):
+    points = np.array([1], dtype=np.int32) if points is None else np.sort(points).astype(np.int32)
+    out = _BoundSchedule(kind, points, cursor, interval, growth, budget, next_t, update_cost, bounds_cost, last_cost, recomputes)
+    setattr(out.__class__, '__getstate__', __getstate)
+    setattr(out.__class__, '__setstate__', __setstate)
+    setattr(out.__class__, '__reduce__', __reduce)
+    setattr(out.__class__, '__deepcopy__', __deepcopy)
+    return out
+
+
+def create_schedule(name, points, interval=1000, growth=2.0, budget=0.1):
+    return BoundSchedule(points, _SCHEDULE_KINDS[name], interval, growth, budget)
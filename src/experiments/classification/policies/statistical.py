@@ -7,6 +7,11 @@ import math
 
 TYPE_UCB = 0
 TYPE_THOMPSON = 1
+TYPE_THOMPSON_WEIGHTS = 2
+
+COVARIANCE_FULL = 0
+COVARIANCE_DIAG = 1
+COVARIANCE_LOWRANK = 2
 
 
 @numba.jitclass([
@@ -22,10 +27,43 @@ TYPE_THOMPSON = 1
     ('A_inv', numba.float64[:,:,:]),
     ('cho', numba.float64[:,:,:]),
     ('recompute', numba.boolean[:]),
-    ('draw_type', numba.int32)
+    ('draw_type', numba.int32),
+    ('covariance', numba.int32),
+    ('rank', numba.int32),
+    ('D', numba.float64[:,:]),
+    ('U', numba.float64[:,:,:]),
+    ('C', numba.float64[:,:,:]),
+    ('M', numba.float64[:,:,:]),
+    ('slot', numba.int64[:]),
+    ('samples', numba.int32),
+    ('ctx_t', numba.int64),
+    ('ctx_indices', numba.int32[:]),
+    ('ctx_data', numba.float64[:]),
+    ('ctx_probs', numba.float64[:])
 ])
 class _StatisticalPolicy:
-    def __init__(self, k, d, l2, alpha, t, w, b, A, A_inv, cho, recompute, draw_type):
+    """
+    Ridge regression per action with UCB or Thompson sampling exploration.
+    The per-action covariance `A` is represented according to `covariance`:
+
+      full:    dense `A` and `A_inv` (k x d x d).
+      diag:    only the diagonal `D` of `A` (k x d).
+      lowrank: the `rank` most recent contexts per action are kept exactly
+               as rows of `U` (k x rank x d), older contexts are folded into
+               the diagonal `D`. `A_inv` follows from the Woodbury identity
+               with `M = C^-1` and `C = I + U D^-1 U^T` (k x rank x rank).
+
+    `TYPE_THOMPSON_WEIGHTS` samples weight vectors from the posterior. In
+    full mode this uses the lower Cholesky factor `cho[a]` of `A_inv[a]`,
+    which is downdated along with every Sherman-Morrison step and only
+    refactorized (lazily, flagged by `recompute`) after a full solve.
+
+    Thompson selection probabilities are computed in closed form, or by
+    Monte-Carlo with `samples` draws if `samples > 0`. The probabilities of
+    the last context (`ctx_*`) are kept until the next update.
+    """
+    def __init__(self, k, d, l2, alpha, t, w, b, A, A_inv, cho, recompute, draw_type, covariance, rank, D, U, C, M, slot,
+                 samples, ctx_t, ctx_indices, ctx_data, ctx_probs):
         self.k = k
         self.d = d
         self.l2 = l2
@@ -39,62 +77,252 @@ class _StatisticalPolicy:
         self.cho = cho
         self.recompute = recompute
         self.draw_type = draw_type
-    
+        self.covariance = covariance
+        self.rank = rank
+        self.D = D
+        self.U = U
+        self.C = C
+        self.M = M
+        self.slot = slot
+        self.samples = samples
+        self.ctx_t = ctx_t
+        self.ctx_indices = ctx_indices
+        self.ctx_data = ctx_data
+        self.ctx_probs = ctx_probs
+
     def update(self, train, index, a, r, update_w=True):
         x, _ = train.get(index)
-        xd = x.to_dense()
-        x2 = xd.reshape((xd.shape[0], 1))
-        self.A[a, :, :] += x2 @ x2.T
-        self.b[a, :] += xd * r
-        if update_w:
-            num = ((self.A_inv[a, :, :] @ x2) @ x2.T) @ self.A_inv[a, :, :]
-            den = ((x2.T @ self.A_inv[a, :, :]) @ x2) + 1.0
-            self.A_inv[a, :, :] -= num / den
-            self.w[:, a] = np.dot(self.A_inv[a, :, :], self.b[a, :])
-        self.recompute[a] = True
+        for i in range(x.nnz):
+            self.b[a, x.indices[i]] += x.data[i] * r
+        if self.covariance == COVARIANCE_FULL:
+            # Only the nnz x nnz block of A changes
+            for i in range(x.nnz):
+                col = x.indices[i]
+                val = x.data[i]
+                for j in range(x.nnz):
+                    self.A[a, col, x.indices[j]] += val * x.data[j]
+            if update_w:
+                self._sherman_morrison(x, a, r)
+            else:
+                self.recompute[a] = True
+        elif self.covariance == COVARIANCE_DIAG:
+            for i in range(x.nnz):
+                col = x.indices[i]
+                self.D[a, col] += x.data[i] ** 2
+                self.w[col, a] = self.b[a, col] / self.D[a, col]
+        elif self.covariance == COVARIANCE_LOWRANK:
+            self._lowrank_insert(x, a)
+            if update_w:
+                self._lowrank_solve(a)
+        else:
+            raise ValueError("Unknown covariance type")
         self.t += 1
 
+    def _sherman_morrison(self, x, a, r):
+        # u = A_inv x only needs the rows of (symmetric) A_inv at the nnz
+        # entries of x, the weights follow from the recursive least squares
+        # form w += u (r - x.w) / (1 + x.u) instead of A_inv b.
+        u = np.zeros(self.d)
+        for i in range(x.nnz):
+            col = x.indices[i]
+            val = x.data[i]
+            for q in range(self.d):
+                u[q] += val * self.A_inv[a, col, q]
+        den = 1.0
+        for i in range(x.nnz):
+            den += x.data[i] * u[x.indices[i]]
+        error = (r - x.dot(self.w[:, a])) / den
+        for p in range(self.d):
+            up = u[p] / den
+            if up != 0.0:
+                for q in range(self.d):
+                    self.A_inv[a, p, q] -= up * u[q]
+            self.w[p, a] += u[p] * error
+        # A_inv loses u u^T / den, the same rank-1 downdate applies to its factor
+        if self.draw_type != TYPE_THOMPSON_WEIGHTS or self.recompute[a] or \
+                not cholesky_downdate(self.cho[a], u / np.sqrt(den)):
+            self.recompute[a] = True
+
+    def _lowrank_insert(self, x, a):
+        s = self.slot[a] % self.rank
+        if self.slot[a] >= self.rank:
+            self._lowrank_evict(a, s)
+        for i in range(x.nnz):
+            self.U[a, s, x.indices[i]] = x.data[i]
+        for t in range(self.rank):
+            c = 0.0
+            for i in range(x.nnz):
+                col = x.indices[i]
+                c += x.data[i] * self.U[a, t, col] / self.D[a, col]
+            self.C[a, s, t] = c
+            self.C[a, t, s] = c
+        self.C[a, s, s] += 1.0
+        self.M[a, :, :] = np.linalg.inv(self.C[a, :, :])
+        self.slot[a] += 1
+
+    def _lowrank_evict(self, a, s):
+        # Fold the outer product of row s into the diagonal. This changes D,
+        # and with it C, only at the non-zeros of the evicted context.
+        for col in range(self.d):
+            u = self.U[a, s, col]
+            if u != 0.0:
+                old = self.D[a, col]
+                new = old + u * u
+                change = 1.0 / new - 1.0 / old
+                for t1 in range(self.rank):
+                    if self.U[a, t1, col] != 0.0:
+                        for t2 in range(self.rank):
+                            self.C[a, t1, t2] += self.U[a, t1, col] * self.U[a, t2, col] * change
+                self.D[a, col] = new
+                self.U[a, s, col] = 0.0
+        self.C[a, s, :] = 0.0
+        self.C[a, :, s] = 0.0
+        self.C[a, s, s] = 1.0
+
+    def _lowrank_solve(self, a):
+        # w = D^-1 b - D^-1 U^T M U D^-1 b
+        y = self.b[a, :] / self.D[a, :]
+        z = np.dot(self.U[a, :, :], y)
+        mz = np.dot(self.M[a, :, :], z)
+        correction = np.dot(mz, self.U[a, :, :])
+        for col in range(self.d):
+            self.w[col, a] = y[col] - correction[col] / self.D[a, col]
+
+    def update_with_propensity(self, train, index, a, r, p, s):
+        self.update(train, index, a, r)
+
+    def update_batch(self, train, indices, actions, rewards, propensities):
+        for b in range(indices.shape[0]):
+            self.update(train, indices[b], actions[b], rewards[b])
+
     def update_w(self, a):
-        self.A_inv[a, :, :] = np.linalg.inv(self.A[a, :, :])
-        self.w[:, a] = np.dot(self.A_inv[a, :, :], self.b[a, :])
-    
+        if self.covariance == COVARIANCE_FULL:
+            self.A_inv[a, :, :] = np.linalg.inv(self.A[a, :, :])
+            self.w[:, a] = np.dot(self.A_inv[a, :, :], self.b[a, :])
+        elif self.covariance == COVARIANCE_DIAG:
+            self.w[:, a] = self.b[a, :] / self.D[a, :]
+        else:
+            self._lowrank_solve(a)
+
     def draw(self, x):
-        xd = x.to_dense()
         if self.draw_type == TYPE_UCB:
-            return self._draw_ucb(xd)
+            return self._draw_ucb(x)
         elif self.draw_type == TYPE_THOMPSON:
-            return self._draw_thompson(xd)
+            return self._draw_thompson(x)
+        elif self.draw_type == TYPE_THOMPSON_WEIGHTS:
+            return self._draw_thompson_weights(x)
         else:
             raise ValueError("Unknown draw type")
-        
+
+    def draw_with_propensity(self, x, index):
+        # The action is drawn like in `draw`, the propensity of Thompson
+        # sampling follows from the same means and bounds
+        means = x.dot(self.w)
+        bounds = self._bound(x)
+        if self.draw_type == TYPE_UCB:
+            return self.draw_scored(means, bounds), 1.0, means
+        elif self.draw_type == TYPE_THOMPSON_WEIGHTS:
+            a = self._draw_thompson_weights(x)
+        else:
+            a = self.draw_scored(means, bounds)
+        return a, self.probability_scored(means, bounds, np.empty(self.k))[a], means
+
     def _bound(self, x):
-        x2 = x.reshape((x.shape[0], 1))
-        d = np.empty(self.k)
-        for i in range(self.k):
-            d[i] = np.sqrt(np.diag(np.dot(np.dot(x2.T, self.A_inv[i,:,:]), x2)))[0]
-        return d
+        return np.sqrt(self._quadratic_forms(x.indices, x.data, np.empty(self.k)))
+
+    def bounds(self, xs, rows):
+        """
+        Computes `_bound` for a block of rows of the CSR matrix `xs` at once.
+        """
+        out = np.empty((rows.shape[0], self.k))
+        for b in range(rows.shape[0]):
+            start = xs.indptr[rows[b]]
+            end = xs.indptr[rows[b] + 1]
+            self._quadratic_forms(xs.indices[start:end], xs.data[start:end], out[b])
+        return np.sqrt(out)
+
+    def _quadratic_forms(self, indices, data, out):
+        # x^T A_inv[i] x for every action i from the non-zeros of x
+        if self.covariance == COVARIANCE_FULL:
+            sparse_quadratic_forms(self.A_inv, indices, data, out)
+        elif self.covariance == COVARIANCE_DIAG:
+            for i in range(self.k):
+                q = 0.0
+                for j in range(indices.shape[0]):
+                    q += data[j] ** 2 / self.D[i, indices[j]]
+                out[i] = q
+        else:
+            z = np.empty(self.rank)
+            for i in range(self.k):
+                q = 0.0
+                for j in range(indices.shape[0]):
+                    q += data[j] ** 2 / self.D[i, indices[j]]
+                for t in range(self.rank):
+                    z[t] = 0.0
+                    for j in range(indices.shape[0]):
+                        col = indices[j]
+                        z[t] += self.U[i, t, col] * data[j] / self.D[i, col]
+                q -= np.dot(z, np.dot(self.M[i, :, :], z))
+                out[i] = max(q, 0.0)
+        return out
+
+    def draw_scored(self, means, bounds):
+        if self.draw_type == TYPE_UCB:
+            return argmax(np.minimum(1.0, means + self.alpha * bounds))
+        elif self.draw_type == TYPE_THOMPSON or self.draw_type == TYPE_THOMPSON_WEIGHTS:
+            # Sampling weights gives the same per-action score distribution
+            s = np.empty(self.k)
+            for i in range(self.k):
+                s[i] = np.random.normal(means[i], self.alpha * bounds[i])
+            return argmax(s)
+        else:
+            raise ValueError("Unknown draw type")
+
+    def probability_scored(self, means, bounds, out):
+        if self.draw_type == TYPE_UCB:
+            out[:] = 0.0
+            out[self.draw_scored(means, bounds)] = 1.0
+            return out
+        elif self.draw_type == TYPE_THOMPSON or self.draw_type == TYPE_THOMPSON_WEIGHTS:
+            return self._thompson_probabilities(means, self.alpha * bounds, out)
+        else:
+            raise ValueError("Unknown draw type")
 
     def _update_cholesky(self):
         for i in range(self.k):
             if self.recompute[i]:
                 self.cho[i,:,:] = np.linalg.cholesky(self.A_inv[i,:,:])
                 self.recompute[i] = False
-    
-    def _draw_ucb(self, x):
-        s = np.dot(x, self.w) + self.alpha * self._bound(x)
-        s = np.minimum(1.0, s)
+
+    def _draw_thompson_weights(self, x):
+        # Scores x.(w + alpha L z) with z ~ N(0, I), where only x^T L is
+        # formed from the rows of L at the non-zeros of x.
+        s = x.dot(self.w)
+        if self.covariance == COVARIANCE_FULL:
+            self._update_cholesky()
+            xl = np.empty(self.d)
+            for i in range(self.k):
+                xl[:] = 0.0
+                for j in range(x.nnz):
+                    col = x.indices[j]
+                    val = x.data[j]
+                    for q in range(col + 1):
+                        xl[q] += val * self.cho[i, col, q]
+                s[i] += self.alpha * np.dot(xl, np.random.standard_normal(self.d))
+        else:
+            for i in range(self.k):
+                for j in range(x.nnz):
+                    s[i] += self.alpha * x.data[j] * np.random.standard_normal() / np.sqrt(self.D[i, x.indices[j]])
         return argmax(s)
 
+    def _draw_ucb(self, x):
+        return self.draw_scored(x.dot(self.w), self._bound(x))
+
     def _draw_thompson(self, x):
         # self._update_cholesky()
         # v = 0.5 * np.sqrt(9 * self.d * np.log(max(1, self.t) / self.delta))
         # u = np.random.standard_normal(self.w.shape)
-        means = np.dot(x, self.w)
-        stds = self.alpha * self._bound(x)
-        s =  np.empty(self.k)
-        for i in range(self.k):
-            s[i] = np.random.normal(means[i], stds[i])
-        return argmax(s)
+        return self.draw_scored(x.dot(self.w), self._bound(x))
         # p = np.random.permutation(ps.shape[0])
         # inv_p = np.argsort(p)
         # cps = np.cumsum(ps[p])
@@ -106,31 +334,139 @@ class _StatisticalPolicy:
 
     def max(self, x):
         return argmax(x.dot(self.w))
-    
+
     def probability(self, x, a):
-        xd = x.to_dense()
+        return self.probabilities(x)[a]
+
+    def probabilities(self, x):
+        if self._cached(x):
+            return self.ctx_probs
         if self.draw_type == TYPE_UCB:
-            return self._probability_ucb(xd)[a]
-        elif self.draw_type == TYPE_THOMPSON:
-            return self._probability_thompson(xd)[a]
+            self._probability_ucb(x, self.ctx_probs)
+        elif self.draw_type == TYPE_THOMPSON or self.draw_type == TYPE_THOMPSON_WEIGHTS:
+            self._probability_thompson(x, self.ctx_probs)
         else:
             raise ValueError("Unknown draw type")
-    
-    def _probability_ucb(self, x):
-        out = np.zeros(self.k)
+        self.ctx_t = self.t
+        self.ctx_indices = np.copy(x.indices)
+        self.ctx_data = np.copy(x.data)
+        return self.ctx_probs
+
+    def _cached(self, x):
+        if self.ctx_t != self.t or self.ctx_indices.shape[0] != x.nnz:
+            return False
+        for i in range(x.nnz):
+            if self.ctx_indices[i] != x.indices[i] or self.ctx_data[i] != x.data[i]:
+                return False
+        return True
+
+    def _probability_ucb(self, x, out):
+        out[:] = 0.0
         out[self._draw_ucb(x)] = 1.0
         return out
 
-    def _probability_thompson(self, x):
+    def _probability_thompson(self, x, out):
         #self._update_cholesky()
-        stds = self._bound(x)
-        means = np.dot(x, self.w)
-        out = np.zeros(self.k)
-        for i in range(self.k):
-            for j in range(self.k):
-                if i != j:
-                    out[i] += np.log(0.5 * math.erfc( (means[j] - means[i]) / math.sqrt(2.0 * (stds[i] + stds[j])) ))
-        return np.exp(out)
+        stds = self.alpha * self._bound(x)
+        means = x.dot(self.w)
+        return self._thompson_probabilities(means, stds, out)
+
+    def _thompson_probabilities(self, means, stds, out):
+        if self.samples > 0:
+            return thompson_probabilities_mc(means, stds, self.samples, out)
+        return thompson_probabilities(means, stds, out)
+
+
+@numba.njit(nogil=True)
+def sparse_quadratic_forms(A_inv, indices, data, out):
+    """
+    Computes `x^T A_inv[i] x` for every `i`, where `x` is the sparse vector
+    given by its non-zero `indices` and `data`. Only the nnz x nnz block of
+    each `A_inv[i]` is read.
+    """
+    for i in range(A_inv.shape[0]):
+        q = 0.0
+        for p in range(indices.shape[0]):
+            s = 0.0
+            row = indices[p]
+            for j in range(indices.shape[0]):
+                s += A_inv[i, row, indices[j]] * data[j]
+            q += data[p] * s
+        out[i] = q
+    return out
+
+
+@numba.njit(nogil=True)
+def cholesky_downdate(L, v):
+    """
+    Updates the lower Cholesky factor `L` of `A` in place to the factor of
+    `A - v v^T` in O(d^2). `v` is overwritten. Returns False if the result
+    is not positive definite, in which case `L` has to be recomputed.
+    """
+    n = L.shape[0]
+    for k in range(n):
+        if v[k] == 0.0:
+            continue
+        r2 = L[k, k] ** 2 - v[k] ** 2
+        if r2 <= 0.0:
+            return False
+        r = np.sqrt(r2)
+        c = r / L[k, k]
+        s = v[k] / L[k, k]
+        L[k, k] = r
+        for i in range(k + 1, n):
+            L[i, k] = (L[i, k] - s * v[i]) / c
+            v[i] = c * v[i] - s * L[i, k]
+    return True
+
+
+@numba.njit(nogil=True)
+def thompson_probabilities(means, stds, out):
+    """
+    Approximates the probability of each action having the largest sample
+    under independent normal scores by the product of its pairwise win
+    probabilities. Each pair is evaluated once, since `P(j > i) = 1 - P(i > j)`.
+    """
+    k = means.shape[0]
+    out[:] = 0.0
+    for i in range(k):
+        for j in range(i + 1, k):
+            z = (means[j] - means[i]) / math.sqrt(2.0 * (stds[i] ** 2 + stds[j] ** 2))
+            p = 0.5 * math.erfc(abs(z)) # probability of the lower mean winning
+            if z >= 0.0:
+                out[i] += math.log(p)
+                out[j] += math.log1p(-p)
+            else:
+                out[i] += math.log1p(-p)
+                out[j] += math.log(p)
+    for i in range(k):
+        out[i] = math.exp(out[i])
+    return out
+
+
+@numba.njit(nogil=True)
+def thompson_probabilities_mc(means, stds, samples, out):
+    """
+    Monte-Carlo estimate of the probability of each action having the
+    largest sample under independent normal scores.
+    """
+    k = means.shape[0]
+    s = np.empty(k)
+    out[:] = 0.0
+    for _ in range(samples):
+        for i in range(k):
+            s[i] = np.random.normal(means[i], stds[i])
+        out[argmax(s)] += 1.0
+    for i in range(k):
+        out[i] /= samples
+    return out
+
+
+COVARIANCE_TYPES = {
+    'full': COVARIANCE_FULL,
+    'diag': COVARIANCE_DIAG,
+    'lowrank': COVARIANCE_LOWRANK
+}
 
 
 def __getstate(self):
@@ -147,7 +483,15 @@ def __getstate(self):
         'A_inv': self.A_inv,
         'cho': self.cho,
         'recompute': self.recompute,
-        'draw_type': self.draw_type
+        'draw_type': self.draw_type,
+        'covariance': self.covariance,
+        'rank': self.rank,
+        'D': self.D,
+        'U': self.U,
+        'C': self.C,
+        'M': self.M,
+        'slot': self.slot,
+        'samples': self.samples
     }
 
 
@@ -165,6 +509,14 @@ def __setstate(self, state):
     self.cho = state['cho']
     self.recompute = state['recompute']
     self.draw_type = state['draw_type']
+    self.covariance = state['covariance']
+    self.rank = state['rank']
+    self.D = state['D']
+    self.U = state['U']
+    self.C = state['C']
+    self.M = state['M']
+    self.slot = state['slot']
+    self.samples = state['samples']
 
 
 def __reduce(self):
@@ -175,18 +527,33 @@ def __deepcopy(self):
     return StatisticalPolicy(self.k, self.d, self.l2, self.alpha, self.t,
                              np.copy(self.w), np.copy(self.b), np.copy(self.A),
                              np.copy(self.A_inv), np.copy(self.cho),
-                             np.copy(self.recompute), self.draw_type)
+                             np.copy(self.recompute), self.draw_type, self.covariance,
+                             self.rank, np.copy(self.D), np.copy(self.U), np.copy(self.C),
+                             np.copy(self.M), np.copy(self.slot), self.samples)
 
 
 def StatisticalPolicy(k, d, l2=1.0, alpha=1.0, t=0, w=None, b=None, A=None, A_inv=None,
-                      cho=None, recompute=None, draw_type=TYPE_UCB, **kw_args):
+                      cho=None, recompute=None, draw_type=TYPE_UCB, covariance=COVARIANCE_FULL,
+                      rank=16, D=None, U=None, C=None, M=None, slot=None, samples=0, **kw_args):
+    if covariance == COVARIANCE_LOWRANK and rank < 1:
+        raise ValueError("Low-rank covariance requires a rank of at least 1")
+    if covariance == COVARIANCE_LOWRANK and draw_type == TYPE_THOMPSON_WEIGHTS:
+        raise ValueError("Weight sampling requires full or diagonal covariance")
+    rank = rank if covariance == COVARIANCE_LOWRANK else 0
+    dd = d if covariance == COVARIANCE_FULL else 0
     w = np.zeros((d, k), dtype=np.float64) if w is None else w
     b = np.zeros((k, d), dtype=np.float64) if b is None else b
-    A = np.stack([np.identity(d, dtype=np.float64) * l2 for _ in range(k)]) if A is None else A
-    A_inv = np.stack([np.identity(d, dtype=np.float64) / l2 for _ in range(k)]) if A_inv is None else A_inv
-    cho = np.stack([np.zeros((d,d), dtype=np.float64) for _ in range(k)]) if cho is None else cho
-    recompute = np.zeros(k, dtype=np.bool) if recompute is None else recompute
-    out = _StatisticalPolicy(k, d, l2, alpha, t, w, b, A, A_inv, cho, recompute, draw_type)
+    A = np.stack([np.identity(dd, dtype=np.float64) * l2 for _ in range(k)]) if A is None else A
+    A_inv = np.stack([np.identity(dd, dtype=np.float64) / l2 for _ in range(k)]) if A_inv is None else A_inv
+    cho = np.stack([np.zeros((dd,dd), dtype=np.float64) for _ in range(k)]) if cho is None else cho
+    recompute = np.ones(k, dtype=np.bool) if recompute is None else recompute
+    D = np.full((k, d - dd), l2, dtype=np.float64) if D is None else D
+    U = np.zeros((k, rank, d), dtype=np.float64) if U is None else U
+    C = np.stack([np.identity(rank, dtype=np.float64) for _ in range(k)]) if C is None else C
+    M = np.stack([np.identity(rank, dtype=np.float64) for _ in range(k)]) if M is None else M
+    slot = np.zeros(k, dtype=np.int64) if slot is None else slot
+    out = _StatisticalPolicy(k, d, l2, alpha, t, w, b, A, A_inv, cho, recompute, draw_type, covariance, rank, D, U, C, M, slot,
+                             samples, -1, np.zeros(0, dtype=np.int32), np.zeros(0), np.zeros(k))
     setattr(out.__class__, '__getstate__', __getstate)
     setattr(out.__class__, '__setstate__', __setstate)
     setattr(out.__class__, '__reduce__', __reduce)
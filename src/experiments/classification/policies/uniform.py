@@ -1,6 +1,7 @@
 import numpy as np
 import numba
-from experiments.classification.policies.util import argmax, init_weights
+from experiments.sparse import csr_rows_dot
+from experiments.classification.policies.util import argmax, init_weights, apply_batch_gradient
 
 
 @numba.jitclass([
@@ -20,7 +21,20 @@ class _UniformPolicy:
     
     def update(self, dataset, index, a, r):
         x, _ = dataset.get(index)
-        s = x.dot(self.w[:, a])
+        self._update(x, a, r, x.dot(self.w[:, a]))
+
+    def update_with_propensity(self, dataset, index, a, r, p, s):
+        x, _ = dataset.get(index)
+        self._update(x, a, r, s[a])
+
+    def update_batch(self, dataset, indices, actions, rewards, propensities):
+        scores = csr_rows_dot(dataset.xs, indices, self.w)
+        coefs = np.zeros_like(scores)
+        for b in range(indices.shape[0]):
+            coefs[b, actions[b]] = scores[b, actions[b]] - rewards[b] # square loss
+        apply_batch_gradient(self.w, dataset.xs, indices, actions, coefs, self.lr, self.l2, False)
+
+    def _update(self, x, a, r, s):
         loss = s - r # square loss reward compared to score (predicted reward)
         for i in range(x.nnz):
             col = x.indices[i]
@@ -29,7 +43,13 @@ class _UniformPolicy:
     
     def draw(self, x):
         return np.random.randint(self.k)
+
+    def draw_scored(self, s):
+        return np.random.randint(self.k)
     
+    def draw_with_propensity(self, x, index):
+        return np.random.randint(self.k), 1.0 / float(self.k), x.dot(self.w)
+
     def max(self, x):
         s = x.dot(self.w)
         return argmax(s)
@@ -37,6 +57,10 @@ class _UniformPolicy:
     def probability(self, x, a):
         return 1.0 / float(self.k)
 
+    def score_probabilities(self, s, out):
+        out[:] = 1.0 / float(self.k)
+        return out
+
 
 def __getstate(self):
     return {
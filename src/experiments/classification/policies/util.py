@@ -1,5 +1,9 @@
 import numba
 import numpy as np
+from experiments.sparse import csr_rows_dot
+
+
+_BOUNDS_BLOCK = 1024
 
 
 @numba.njit(nogil=True)
@@ -20,6 +24,187 @@ def argmax(scores):
     return best_action
 
 
+@numba.njit(nogil=True)
+def softmax_into(s, tau, out):
+    m = np.max(s)
+    total = 0.0
+    for j in range(s.shape[0]):
+        out[j] = np.exp((s[j] - m) / tau)
+        total += out[j]
+    for j in range(s.shape[0]):
+        out[j] /= total
+    return out
+
+
+@numba.njit(nogil=True)
+def log_softmax_into(s, tau, out):
+    lse = log_sum_exp(s, tau)
+    for j in range(s.shape[0]):
+        out[j] = s[j] / tau - lse
+    return out
+
+
+@numba.njit(nogil=True)
+def log_sum_exp(s, tau):
+    m = np.max(s)
+    total = 0.0
+    for j in range(s.shape[0]):
+        total += np.exp((s[j] - m) / tau)
+    return m / tau + np.log(total)
+
+
+@numba.njit(nogil=True)
+def gumbel_argmax(s, tau):
+    best_score = -np.inf
+    best_action = 0
+    for a in range(s.shape[0]):
+        g = s[a] / tau - np.log(-np.log(np.random.uniform(0.0, 1.0)))
+        if g > best_score:
+            best_action = a
+            best_score = g
+    return best_action
+
+
+@numba.njit(nogil=True)
+def greedy_into(s, out):
+    m = np.max(s)
+    count = 0.0
+    for j in range(s.shape[0]):
+        out[j] = 1.0 if s[j] == m else 0.0
+        count += out[j]
+    for j in range(s.shape[0]):
+        out[j] /= count
+    return out
+
+
+@numba.njit(nogil=True)
+def bound_sums(xs, ips, w, tau, baseline):
+    """
+    Computes the IPS bound sums over all logged cells in `ips` for the
+    softmax policy with weights `w`, and for `baseline` if its weights were
+    replaced by `w`. Touched rows are scored in blocks with a single sparse
+    times dense product per block.
+    """
+    return _bound_sums_range(xs, ips, w, tau, baseline, 0, ips.n_rows)
+
+
+@numba.njit(nogil=True, parallel=True)
+def bound_sums_parallel(xs, ips, w, tau, baseline, chunks):
+    """
+    Parallel version of `bound_sums`. The touched rows are split into a fixed
+    number of `chunks` whose partial sums are combined in chunk order, so the
+    result only depends on `chunks` and not on the number of threads.
+    """
+    partial = np.zeros((chunks, 6))
+    for c in numba.prange(chunks):
+        start = (c * ips.n_rows) // chunks
+        end = ((c + 1) * ips.n_rows) // chunks
+        sums = _bound_sums_range(xs, ips, w, tau, baseline, start, end)
+        for i in range(6):
+            partial[c, i] = sums[i]
+    new_sum_mean = 0.0
+    new_sum_var = 0.0
+    new_max = 0.0
+    swap_sum_mean = 0.0
+    swap_sum_var = 0.0
+    swap_max = 0.0
+    for c in range(chunks):
+        new_sum_mean += partial[c, 0]
+        new_sum_var += partial[c, 1]
+        new_max = max(new_max, partial[c, 2])
+        swap_sum_mean += partial[c, 3]
+        swap_sum_var += partial[c, 4]
+        swap_max = max(swap_max, partial[c, 5])
+    return new_sum_mean, new_sum_var, new_max, swap_sum_mean, swap_sum_var, swap_max
+
+
+@numba.njit(nogil=True)
+def _bound_sums_range(xs, ips, w, tau, baseline, first, last):
+    new_sum_mean = 0.0
+    new_sum_var = 0.0
+    new_max = 0.0
+    swap_sum_mean = 0.0
+    swap_sum_var = 0.0
+    swap_max = 0.0
+    swap_ps = np.empty(w.shape[1])
+    for start in range(first, last, _BOUNDS_BLOCK):
+        end = min(last, start + _BOUNDS_BLOCK)
+        scores = csr_rows_dot(xs, ips.rows[start:end], w)
+        for i in range(end - start):
+            baseline.score_probabilities(scores[i], swap_ps)
+            new_ps = softmax_into(scores[i], tau, scores[i])
+            entry = ips.heads[start + i]
+            while entry != -1:
+                a = ips.cols[entry]
+                new_sum_mean += new_ps[a] * ips.data[entry]
+                new_sum_var += new_ps[a]**2 * ips.data2[entry]
+                new_max = max(new_max, new_ps[a] * ips.data[entry])
+                swap_sum_mean += swap_ps[a] * ips.data[entry]
+                swap_sum_var += swap_ps[a]**2 * ips.data2[entry]
+                swap_max = max(swap_max, swap_ps[a] * ips.data[entry])
+                entry = ips.links[entry]
+    return new_sum_mean, new_sum_var, new_max, swap_sum_mean, swap_sum_var, swap_max
+
+
+@numba.njit(nogil=True)
+def softmax_coefs(scores, actions, losses, tau):
+    """
+    Per-row gradient coefficients of a softmax policy, scaled by `losses`,
+    for use with `apply_batch_gradient`. Overwrites `scores`.
+    """
+    coefs = np.zeros_like(scores)
+    for b in range(scores.shape[0]):
+        sm = softmax_into(scores[b], tau, scores[b])
+        a = actions[b]
+        for aprime in range(scores.shape[1]):
+            kronecker = 1.0 if aprime == a else 0.0
+            coefs[b, aprime] = (1.0 / tau) * losses[b] * sm[aprime] * (kronecker - sm[a])
+    return coefs
+
+
+@numba.njit(nogil=True)
+def apply_batch_gradient(w, xs, rows, actions, coefs, lr, l2, all_actions):
+    """
+    Applies one aggregated gradient step for a batch of interactions with
+    the weights frozen at their value before the batch. The gradient of row
+    `b` with respect to `w[col, :]` is `xs[rows[b], col] * coefs[b, :]` plus
+    the l2 term, which covers all actions or only `actions[b]`.
+    """
+    nnz = 0
+    for b in range(rows.shape[0]):
+        nnz += xs.indptr[rows[b] + 1] - xs.indptr[rows[b]]
+    cols = np.empty(nnz, dtype=np.int32)
+    nnz = 0
+    for b in range(rows.shape[0]):
+        for i in range(xs.indptr[rows[b]], xs.indptr[rows[b] + 1]):
+            cols[nnz] = xs.indices[i]
+            nnz += 1
+    cols = np.unique(cols)
+    grad = np.zeros((cols.shape[0], w.shape[1]))
+    for b in range(rows.shape[0]):
+        a = actions[b]
+        for i in range(xs.indptr[rows[b]], xs.indptr[rows[b] + 1]):
+            col = xs.indices[i]
+            val = xs.data[i]
+            pos = np.searchsorted(cols, col)
+            if all_actions:
+                for j in range(w.shape[1]):
+                    grad[pos, j] += val * coefs[b, j] + l2 * w[col, j]
+            else:
+                grad[pos, a] += val * coefs[b, a] + l2 * w[col, a]
+    for u in range(cols.shape[0]):
+        for j in range(w.shape[1]):
+            w[cols[u], j] -= lr * grad[u, j]
+
+
+@numba.njit(nogil=True)
+def rows_nnz(xs, rows):
+    total = 0
+    for i in range(rows.shape[0]):
+        total += xs.indptr[rows[i] + 1] - xs.indptr[rows[i]]
+    return total
+
+
 def init_weights(k, d, w):
     if w is None:
         w = np.zeros((d, k), dtype=np.float64)
@@ -0,0 +1,123 @@
+import numpy as np
+import numba
+from scipy.sparse import csr_matrix
+from experiments.sparse import from_scipy, to_scipy, csr_rows_dot
+
+
+_sparse_m = numba.typeof(from_scipy(csr_matrix((0,0))))
+
+
+@numba.jitclass([
+    ('xs', _sparse_m),
+    ('xt', _sparse_m),
+    ('rows', numba.int64[:]),
+    ('scores', numba.float64[:,:]),
+    ('w', numba.float64[:,:]),
+    ('density', numba.float64),
+    ('valid', numba.boolean),
+    ('rescores', numba.int64),
+    ('increments', numba.int64)
+])
+class _ScoreTable:
+    """
+    Persistent scores `xs @ w` of a fixed set of rows. `xt` is the transpose
+    of `xs` in CSR form, i.e. a column (CSC) index of the rows, and `w` the
+    weights the scores were computed with. On `refresh` only the weight rows
+    that changed are applied, to the rows that contain the feature. If the
+    changed columns cover more than `density` of the non-zeros, the table is
+    rescored in full instead.
+    """
+    def __init__(self, xs, xt, rows, scores, w, density, valid, rescores, increments):
+        self.xs = xs
+        self.xt = xt
+        self.rows = rows
+        self.scores = scores
+        self.w = w
+        self.density = density
+        self.valid = valid
+        self.rescores = rescores
+        self.increments = increments
+
+    def refresh(self, w):
+        changed = np.empty(w.shape[0], dtype=np.int64)
+        n_changed = 0
+        cost = 0
+        for col in range(w.shape[0]):
+            for j in range(w.shape[1]):
+                if w[col, j] != self.w[col, j]:
+                    changed[n_changed] = col
+                    n_changed += 1
+                    cost += self.xt.indptr[col + 1] - self.xt.indptr[col]
+                    break
+        if not self.valid or cost > self.density * self.xs.nnz:
+            self.scores[:, :] = csr_rows_dot(self.xs, self.rows, w)
+            self.w[:, :] = w
+            self.valid = True
+            self.rescores += 1
+            return self.scores
+        for c in range(n_changed):
+            col = changed[c]
+            for i in range(self.xt.indptr[col], self.xt.indptr[col + 1]):
+                row = self.xt.indices[i]
+                val = self.xt.data[i]
+                for j in range(w.shape[1]):
+                    self.scores[row, j] += val * (w[col, j] - self.w[col, j])
+            self.w[col, :] = w[col, :]
+        self.increments += 1
+        return self.scores
+
+
+def __getstate(self):
+    return {
+        'xs': self.xs,
+        'xt': self.xt,
+        'rows': self.rows,
+        'scores': self.scores,
+        'w': self.w,
+        'density': self.density,
+        'valid': self.valid,
+        'rescores': self.rescores,
+        'increments': self.increments
+    }
+
+
+def __setstate(self, state):
+    self.xs = state['xs']
+    self.xt = state['xt']
+    self.rows = state['rows']
+    self.scores = state['scores']
+    self.w = state['w']
+    self.density = state['density']
+    self.valid = state['valid']
+    self.rescores = state['rescores']
+    self.increments = state['increments']
+
+
+def __reduce(self):
+    return (_score_table, (self.xs, self.xt, self.scores.shape[1], self.density), self.__getstate__())
+
+
+def __deepcopy(self):
+    return _score_table(self.xs, self.xt, self.scores.shape[1], self.density, np.copy(self.scores),
+                        np.copy(self.w), self.valid, self.rescores, self.increments)
+
+
+def ScoreTable(xs, rows, k, density=0.3):
+    """
+    Creates the score table of the rows `rows` of the CSR matrix `xs` for `k`
+    actions. The scores are computed on the first `refresh`.
+    """
+    subset = to_scipy(xs)[rows]
+    return _score_table(from_scipy(subset), from_scipy(subset.T.tocsr()), k, density)
+
+
+def _score_table(xs, xt, k, density, scores=None, w=None, valid=False, rescores=0, increments=0):
+    rows = np.arange(xs.shape[0], dtype=np.int64)
+    scores = np.zeros((xs.shape[0], k)) if scores is None else scores
+    w = np.zeros((xs.shape[1], k)) if w is None else w
+    out = _ScoreTable(xs, xt, rows, scores, w, density, valid, rescores, increments)
+    setattr(out.__class__, '__getstate__', __getstate)
+    setattr(out.__class__, '__setstate__', __setstate)
+    setattr(out.__class__, '__reduce__', __reduce)
+    setattr(out.__class__, '__deepcopy__', __deepcopy)
+    return out
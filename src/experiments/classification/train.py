@@ -3,6 +3,7 @@ import numpy as np
 import numba
 import matplotlib
 import json
+from functools import partial
 from matplotlib import pyplot as plt
 from scipy import stats as st
 from joblib.memory import Memory
@@ -11,16 +12,19 @@ from backflow import task
 from backflow.schedulers import MultiThreadScheduler
 from backflow.results import sqlite_result
 from experiments.classification.policies import create_policy
-from experiments.classification.optimization import optimize
-from experiments.classification.evaluation import evaluate
+from experiments.classification.optimization import optimize, optimize_batch
+from experiments.classification.evaluation import evaluate_statistical_parallel, evaluate_scored, evaluate_statistical, incremental_evaluator, evaluation_snapshot
 from experiments.classification.baseline import best_baseline, statistical_baseline
 from experiments.classification.dataset import load_train, load_test, load_vali
-from experiments.util import rng_seed, get_evaluation_points, mkdir_if_not_exists, NumpyEncoder
+from experiments.util import rng_seed, get_evaluation_points, mkdir_if_not_exists, NumpyEncoder, SnapshotEvaluator, run_in_processes, MemoryBudget
+
+
+_LOG_FORMAT = "[%(asctime)s] %(levelname)-5s %(threadName)35s: %(message)s"
+_PROCESS_OVERHEAD = 512 * 2**20
 
 
 def main():
-    logging.basicConfig(format="[%(asctime)s] %(levelname)-5s %(threadName)35s: %(message)s",
-                        level=logging.INFO)
+    logging.basicConfig(format=_LOG_FORMAT, level=logging.INFO)
     logging.getLogger('sqlitedict').setLevel(logging.WARNING)
     cli_parser = ArgumentParser()
     cli_parser.add_argument("-c", "--config", type=str, required=True)
@@ -32,7 +36,17 @@ def main():
     cli_parser.add_argument("--iterations", type=int, default=1000000)
     cli_parser.add_argument("--evaluations", type=int, default=50)
     cli_parser.add_argument("--eval_scale", choices=('lin', 'log'), default='log')
+    cli_parser.add_argument("--batch", type=int, default=1)
+    cli_parser.add_argument("--eval_mode", choices=('sampled', 'expected'), default='sampled')
+    cli_parser.add_argument("--eval_incremental", action='store_true')
+    cli_parser.add_argument("--rescore_density", type=float, default=0.3)
+    cli_parser.add_argument("--eval_async", action='store_true')
+    cli_parser.add_argument("--processes", type=int, default=0)
+    cli_parser.add_argument("--retries", type=int, default=2)
+    cli_parser.add_argument("--memory_budget", type=float, default=0.0)
     args = cli_parser.parse_args()
+    if args.memory_budget > 0.0 and args.processes == 0:
+        cli_parser.error("--memory_budget requires --processes")
 
     parser = ArgumentParser()
     parser.add_argument("--strategy", type=str, default='epsgreedy')
@@ -43,6 +57,15 @@ def main():
     parser.add_argument("--tau", type=float, default=1.0)
     parser.add_argument("--alpha", type=float, default=1.0)
     parser.add_argument("--cap", type=float, default=0.1)
+    parser.add_argument("--parallel_blocks", type=int, default=0)
+    parser.add_argument("--bounds_schedule", choices=('fixed', 'geometric', 'budget'), default='fixed')
+    parser.add_argument("--bounds_interval", type=int, default=1000)
+    parser.add_argument("--bounds_growth", type=float, default=2.0)
+    parser.add_argument("--bounds_budget", type=float, default=0.1)
+    parser.add_argument("--baseline_cache", action='store_true')
+    parser.add_argument("--covariance", choices=('full', 'diag', 'lowrank'), default='full')
+    parser.add_argument("--rank", type=int, default=16)
+    parser.add_argument("--thompson_samples", type=int, default=0)
     parser.add_argument("--label", type=str, default=None)
 
     # Read experiment configuration
@@ -50,11 +73,24 @@ def main():
         lines = f.readlines()
         configs = [parser.parse_args(line.strip().split(" ")) for line in lines]
 
-    # Run experiments in task executor
-    with MultiThreadScheduler(args.parallel) as scheduler:
-        results = [run_experiment(config, args.dataset, args.repeats, args.iterations, args.evaluations, args.eval_scale) for config in configs]
-        scheduler.block_until_tasks_finish()
-    results = [r.result.value for r in results]
+    run_args = {
+        'batch': args.batch,
+        'eval_mode': args.eval_mode,
+        'eval_incremental': args.rescore_density if args.eval_incremental else 0.0,
+        'eval_async': args.eval_async
+    }
+
+    if args.processes > 0:
+        # Run every seed of every config in its own worker process
+        budget = MemoryBudget(args.memory_budget * 2**30) if args.memory_budget > 0.0 else None
+        results = run_experiments_in_processes(configs, args.dataset, args.repeats, args.iterations, args.evaluations,
+                                               args.eval_scale, args.processes, args.retries, budget=budget, **run_args)
+    else:
+        # Run experiments in task executor
+        with MultiThreadScheduler(args.parallel) as scheduler:
+            results = [run_experiment(config, args.dataset, args.repeats, args.iterations, args.evaluations, args.eval_scale, **run_args) for config in configs]
+            scheduler.block_until_tasks_finish()
+        results = [r.result.value for r in results]
 
     # Write json results
     mkdir_if_not_exists(f"results/{args.output}.json")
@@ -68,7 +104,7 @@ def main():
         reverse = False if metric == 'regret' else True
         for result, config in sorted(zip(results, configs), key=lambda e: e[0][metric]['conf'][bound][-1], reverse=reverse):
             tune_p = config.lr
-            if config.strategy in ["ucb", "thompson"]:
+            if config.strategy in ["ucb", "thompson", "thompson_weights"]:
                 tune_p = config.alpha
             logging.info(f"{args.dataset} {config.strategy} ({tune_p}, {config.l2}) = {metric}: {result[metric]['mean'][-1]:.4f} +/- {result[metric]['std'][-1]:.4f} => {result[metric]['conf'][bound][-1]:.4f}")
 
@@ -104,7 +140,8 @@ def main():
 
 
 @task
-async def run_experiment(config, data, repeats, iterations, evaluations, eval_scale, seed_base=4200, vali=0.0):
+async def run_experiment(config, data, repeats, iterations, evaluations, eval_scale, seed_base=4200, vali=0.0, batch=1,
+                         eval_mode='sampled', eval_incremental=0.0, eval_async=False):
 
     # points to evaluate at
     points = get_evaluation_points(iterations, evaluations, eval_scale)
@@ -112,11 +149,89 @@ async def run_experiment(config, data, repeats, iterations, evaluations, eval_sc
     # Evaluate at all points and all seeds
     results = []
     for seed in range(seed_base, seed_base + repeats):
-        results.append(classification_run(config, data, points, seed, vali))
+        results.append(classification_run(config, data, points, seed, vali, batch, eval_mode, eval_incremental, eval_async))
 
     # Await results to finish computing
     results = [await r for r in results]
+    return aggregate_runs(results, points)
+
+
+def run_experiments_in_processes(configs, data, repeats, iterations, evaluations, eval_scale, processes, retries=2,
+                                 budget=None, seed_base=4200, vali=0.0, batch=1, eval_mode='sampled',
+                                 eval_incremental=0.0, eval_async=False):
+    """
+    Process-pool version of `run_experiment` for a list of configs. Datasets
+    are converted once up front, after which every worker maps the same
+    array cache instead of holding a private copy. Baselines are shared the
+    same way through their cache, only configs and per-run results are
+    pickled across processes. They are trained here before any run starts,
+    so workers do not train the same baseline concurrently. With a
+    `MemoryBudget`, runs are admitted by their estimated peak memory.
+    """
+    points = get_evaluation_points(iterations, evaluations, eval_scale)
+    seeds = range(seed_base, seed_base + repeats)
+    with MultiThreadScheduler(1) as scheduler:
+        loads = {seed: (load_train(data, seed), load_test(data, seed)) for seed in seeds}
+        scheduler.block_until_tasks_finish()
+        baselines = {}
+        for config in configs:
+            for seed in seeds:
+                key = (seed, config.strategy, config.l2, config.covariance, config.rank)
+                if config.strategy not in ['ucb', 'thompson', 'thompson_weights']:
+                    key = (seed,)
+                if key not in baselines:
+                    baselines[key] = build_baseline(config, data, seed)
+        scheduler.block_until_tasks_finish()
+    jobs = []
+    profiles = []
+    for config in configs:
+        for seed in seeds:
+            train, test = (load.result.value for load in loads[seed])
+            jobs.append((config, data, points, seed, vali, batch, eval_mode, eval_incremental, eval_async))
+            profiles.append(estimate_run_memory(config, data, train, test, np.max(points), eval_async))
+    runs = run_in_processes(_process_run, jobs, processes, retries, budget, profiles)
+    return [aggregate_runs(runs[i * repeats:(i + 1) * repeats], points) for i in range(len(configs))]
+
+
+def estimate_run_memory(config, data, train, test, iterations, eval_async=False):
+    """
+    Returns the key under which the peak memory of a classification run is
+    recorded, and a rough estimate of that peak in bytes from the dataset
+    dimensions and the strategy. The memory-mapped datasets are shared
+    between processes and not counted.
+    """
+    d, k = train.d, train.k
+    # baseline and policy, plus the evaluation snapshot
+    copies = 3 if eval_async else 2
+    if config.strategy in ['ucb', 'thompson', 'thompson_weights']:
+        key = f"{data}/{config.strategy}/{config.covariance}"
+        per_copy = {
+            'full': 3 * k * d * d,
+            'diag': k * d,
+            'lowrank': k * config.rank * d + 2 * k * config.rank ** 2
+        }[config.covariance] + 2 * k * d
+    else:
+        key = f"{data}/{config.strategy}"
+        per_copy = 2 * d * k
+    out = copies * per_copy * 8
+    if config.strategy in ['sea', 'comp']:
+        # IPS accumulator entries and the optional dense baseline cache
+        out += min(train.n * k, iterations) * 40 + (train.n * k * 4 if config.baseline_cache else 0)
+    # score matrices of the evaluation
+    out += 2 * test.n * k * 8
+    return key, _PROCESS_OVERHEAD + out
+
 
+def _process_run(*args):
+    logging.basicConfig(format=_LOG_FORMAT, level=logging.INFO)
+    logging.getLogger('sqlitedict').setLevel(logging.WARNING)
+    with MultiThreadScheduler(1) as scheduler:
+        run = classification_run(*args)
+        scheduler.block_until_tasks_finish()
+    return run.result.value
+
+
+def aggregate_runs(results, points):
     # Combine results with different seeded repeats
     results = {
         "learned": np.vstack([x["learned"] for x in results]),
@@ -142,7 +257,8 @@ async def run_experiment(config, data, repeats, iterations, evaluations, eval_sc
 
 
 @task(result_fn=sqlite_result(".cache/results.sqlite"))
-async def classification_run(config, data, points, seed, vali=0.0):
+async def classification_run(config, data, points, seed, vali=0.0, batch=1, eval_mode='sampled', eval_incremental=0.0,
+                             eval_async=False):
 
     # Load train, test and policy
     train = load_train(data, seed)
@@ -172,27 +288,43 @@ async def classification_run(config, data, points, seed, vali=0.0):
     else:
         vali_indices = train_indices
 
-    # Evaluate on point 0
+    # Evaluate on the test set, or on the held-out part of train
     if vali == 0.0:
-        out['deploy'][0], out['learned'][0] = evaluate(test, policy, np.arange(0, test.n))
+        eval_data, eval_indices = test, np.arange(0, test.n)
     else:
-        out['deploy'][0], out['learned'][0] = evaluate(train, policy, indices_shuffle[np.arange(int(vali * train.n), train.n)])
-    out['regret'][0] = 0.0
-    out['test_regret'][0] = 0.0
-    log_progress(0, points, data, out, policy, config, seed)
-
-    # Train and evaluate at specified points
-    for i in range(1, len(points)):
-        start = points[i - 1]
-        end = points[i]
-        train_regret, test_regret = optimize(train, np.copy(train_indices[start:end]), np.copy(vali_indices[start:end]), policy)
-        out['regret'][i] = out['regret'][i - 1] + train_regret
-        out['test_regret'][i] = out['test_regret'][i - 1] + test_regret
-        if vali == 0.0:
-            out['deploy'][i], out['learned'][i] = evaluate(test, policy, np.arange(0, test.n))
+        eval_data, eval_indices = train, indices_shuffle[np.arange(int(vali * train.n), train.n)]
+
+    # Evaluate on point 0
+    expected = eval_mode == 'expected'
+    evaluate_fn = partial(evaluate_scored, blocks=config.parallel_blocks, expected=expected)
+    if config.strategy in ['ucb', 'thompson', 'thompson_weights']:
+        if config.parallel_blocks > 0 and not expected:
+            evaluate_fn = evaluate_statistical_parallel
         else:
-            out['deploy'][i], out['learned'][i] = evaluate(train, policy, indices_shuffle[np.arange(int(vali * train.n), train.n)])
-        log_progress(i, points, data, out, policy, config, seed)
+            evaluate_fn = partial(evaluate_statistical, expected=expected)
+    elif eval_incremental > 0.0:
+        evaluate_fn = incremental_evaluator(eval_data, eval_indices, eval_incremental, expected)
+
+    def evaluate_point(index, policy):
+        out['deploy'][index], out['learned'][index] = evaluate_fn(eval_data, policy, eval_indices)
+        log_progress(index, points, data, out, policy, config, seed)
+
+    with SnapshotEvaluator(eval_async, seed, evaluation_snapshot) as evaluator:
+        out['regret'][0] = 0.0
+        out['test_regret'][0] = 0.0
+        evaluator.submit(0, policy, partial(evaluate_point, 0))
+
+        # Train and evaluate at specified points
+        for i in range(1, len(points)):
+            start = points[i - 1]
+            end = points[i]
+            if batch > 1:
+                train_regret, test_regret = optimize_batch(train, np.copy(train_indices[start:end]), np.copy(vali_indices[start:end]), policy, batch)
+            else:
+                train_regret, test_regret = optimize(train, np.copy(train_indices[start:end]), np.copy(vali_indices[start:end]), policy)
+            out['regret'][i] = out['regret'][i - 1] + train_regret
+            out['test_regret'][i] = out['test_regret'][i - 1] + test_regret
+            evaluator.submit(i, policy, partial(evaluate_point, i))
 
     return out
 
@@ -200,14 +332,12 @@ async def classification_run(config, data, points, seed, vali=0.0):
 @task
 async def build_policy(config, data, points, seed):
     train = load_train(data, seed)
-    if config.strategy in ['ucb', 'thompson']:
-        baseline = statistical_baseline(data, config.l2, seed, config.strategy)
-    else:
-        baseline = best_baseline(data, seed)
+    baseline = build_baseline(config, data, seed)
     train, baseline = await train, await baseline
-    if not config.cold and config.strategy in ['ucb', 'thompson']:
+    if not config.cold and config.strategy in ['ucb', 'thompson', 'thompson_weights']:
         out = baseline.__deepcopy__()
         out.alpha = config.alpha
+        out.samples = config.thompson_samples
         return out
     args = {'k': train.k, 'd': train.d, 'n': train.n, 'baseline': baseline}
     args.update(vars(config))
@@ -220,11 +350,21 @@ async def build_policy(config, data, points, seed):
     return create_policy(**args)
 
 
+def build_baseline(config, data, seed):
+    if config.strategy in ['ucb', 'thompson', 'thompson_weights']:
+        return statistical_baseline(data, config.l2, seed, config.strategy, config.covariance, config.rank)
+    return best_baseline(data, seed)
+
+
 def log_progress(index, points, data, out, policy, config, seed):
     bounds = ""
     if hasattr(policy, 'ucb_baseline') and hasattr(policy, 'lcb_w'):
         bounds = f" :: {policy.lcb_w:.6f} ?> {policy.ucb_baseline:.6f}"
-    tune = f"a={config.alpha:.4g}, l2={config.l2:.4g}" if config.strategy in ["ucb", "thompson"] else f"lr={config.lr:.4g}, l2={config.l2:.4g}"
+    if hasattr(policy, 'schedule'):
+        schedule = policy.schedule
+        share = schedule.bounds_cost / max(1.0, schedule.bounds_cost + schedule.update_cost)
+        bounds += f" ({schedule.recomputes} recomputes, {100 * share:.1f}% of work)"
+    tune = f"a={config.alpha:.4g}, l2={config.l2:.4g}" if config.strategy in ["ucb", "thompson", "thompson_weights"] else f"lr={config.lr:.4g}, l2={config.l2:.4g}"
     logging.info(f"[{seed}, {points[index]:7d}] {data} {config.strategy} ({tune}): test deploy:  {out['deploy'][index]:.4f} {bounds}")
     logging.info(f"[{seed}, {points[index]:7d}] {data} {config.strategy} ({tune}): test learned: {out['learned'][index]:.4f}")
     logging.info(f"[{seed}, {points[index]:7d}] {data} {config.strategy} ({tune}): regret:       {out['regret'][index]:.4f}")
@@ -44,6 +44,10 @@ def main():
     parser.add_argument("--tau", type=float, default=1.0)
     parser.add_argument("--alpha", type=float, default=1.0)
     parser.add_argument("--cap", type=float, default=0.1)
+    parser.add_argument("--parallel_blocks", type=int, default=0)
+    parser.add_argument("--covariance", choices=('full', 'diag', 'lowrank'), default='full')
+    parser.add_argument("--rank", type=int, default=16)
+    parser.add_argument("--thompson_samples", type=int, default=0)
 
     # Read experiment configuration
     with open(args.config, 'rt') as f:
@@ -78,7 +82,7 @@ def main():
 @task
 async def target_fn(x0, x1, config, data, repeats, iterations, seed_base, call_uid=None):
     new_config = deepcopy(config)
-    if new_config.strategy in ['ucb', 'thompson']:
+    if new_config.strategy in ['ucb', 'thompson', 'thompson_weights']:
         new_config.alpha = x0
     else:
         new_config.lr = x0
@@ -3,6 +3,9 @@ import numba
 from ltrpy.evaluation.ndcg import ndcg
 
 
+_EVALUATION_BLOCK = 64
+
+
 @numba.njit(nogil=True)
 def evaluate(test, policy):
     scores = np.zeros(test.size)
@@ -16,6 +19,25 @@ def evaluate(test, policy):
     return np.mean(scores), np.mean(scores2)
 
 
+@numba.njit(nogil=True, parallel=True)
+def evaluate_parallel(test, policy):
+    # Queries are drawn in fixed blocks that each seed the random state of
+    # their thread from the state of the caller, so the sampled rankings do
+    # not depend on the thread schedule
+    scores = np.zeros(test.size)
+    scores2 = np.zeros(test.size)
+    seed = np.random.randint(0, 2**31 - 1)
+    for block in numba.prange((test.size + _EVALUATION_BLOCK - 1) // _EVALUATION_BLOCK):
+        np.random.seed(seed + block)
+        for i in range(block * _EVALUATION_BLOCK, min(test.size, (block + 1) * _EVALUATION_BLOCK)):
+            x, y, q = test.get(i)
+            ranking = policy.draw(x)
+            ranking2 = policy.max(x)
+            scores[i] = ndcg(ranking, y)[:10][-1]
+            scores2[i] = ndcg(ranking2, y)[:10][-1]
+    return np.mean(scores), np.mean(scores2)
+
+
 @numba.njit(nogil=True)
 def evaluate_fraction(test, policy, fraction):
     size = int(fraction * test.size)
@@ -3,15 +3,16 @@ import numpy as np
 import numba
 import matplotlib
 import json
+from functools import partial
 from matplotlib import pyplot as plt
 from scipy import stats as st
 from joblib.memory import Memory
 from argparse import ArgumentParser
 from rulpy.pipeline import task, TaskExecutor
-from experiments.util import rng_seed, get_evaluation_points, mkdir_if_not_exists, NumpyEncoder
+from experiments.util import rng_seed, get_evaluation_points, mkdir_if_not_exists, NumpyEncoder, SnapshotEvaluator, run_in_processes
 from experiments.ranking.dataset import load_test, load_train
 from experiments.ranking.policies import create_policy
-from experiments.ranking.evaluation import evaluate
+from experiments.ranking.evaluation import evaluate, evaluate_parallel
 from experiments.ranking.optimization import optimize
 from experiments.ranking.baseline import best_baseline
 from ltrpy.clicks.position import position_binarized_5, near_random_5
@@ -20,9 +21,11 @@ from ltrpy.clicks.cascading import navigational_5
 from ltrpy.clicks.cascading import informational_5
 
 
+_LOG_FORMAT = "[%(asctime)s] %(levelname)s %(threadName)-23s: %(message)s"
+
+
 def main():
-    logging.basicConfig(format="[%(asctime)s] %(levelname)s %(threadName)-23s: %(message)s",
-                        level=logging.INFO)
+    logging.basicConfig(format=_LOG_FORMAT, level=logging.INFO)
     cli_parser = ArgumentParser()
     cli_parser.add_argument("-c", "--config", type=str, required=True)
     cli_parser.add_argument("-d", "--dataset", type=str, required=True)
@@ -34,6 +37,9 @@ def main():
     cli_parser.add_argument("--iterations", type=int, default=1000000)
     cli_parser.add_argument("--evaluations", type=int, default=50)
     cli_parser.add_argument("--eval_scale", choices=('lin', 'log'), default='log')
+    cli_parser.add_argument("--eval_async", action='store_true')
+    cli_parser.add_argument("--processes", type=int, default=0)
+    cli_parser.add_argument("--retries", type=int, default=2)
     args = cli_parser.parse_args()
 
     parser = ArgumentParser()
@@ -42,6 +48,7 @@ def main():
     parser.add_argument("--lr", type=float, default=0.01)
     parser.add_argument("--cap", type=float, default=0.01)
     parser.add_argument("--confidence", type=float, default=0.95)
+    parser.add_argument("--parallel_blocks", type=int, default=0)
     parser.add_argument("--label", type=str, default=None)
 
     # Read experiment configuration
@@ -49,10 +56,16 @@ def main():
         lines = f.readlines()
         configs = [parser.parse_args(line.strip().split(" ")) for line in lines]
 
-    # Run experiments in task executor
-    with TaskExecutor(max_workers=args.parallel, memory=Memory(args.cache, compress=6)):
-        results = [run_experiment(config, args.dataset, args.behavior, args.repeats, args.iterations, args.evaluations, args.eval_scale) for config in configs]
-    results = [r.result for r in results]
+    if args.processes > 0:
+        # Run every seed of every config in its own worker process
+        results = run_experiments_in_processes(configs, args.dataset, args.behavior, args.repeats, args.iterations,
+                                               args.evaluations, args.eval_scale, args.processes, args.retries,
+                                               cache=args.cache, eval_async=args.eval_async)
+    else:
+        # Run experiments in task executor
+        with TaskExecutor(max_workers=args.parallel, memory=Memory(args.cache, compress=6)):
+            results = [run_experiment(config, args.dataset, args.behavior, args.repeats, args.iterations, args.evaluations, args.eval_scale, eval_async=args.eval_async) for config in configs]
+        results = [r.result for r in results]
 
     # Write json results
     mkdir_if_not_exists(f"results/{args.output}.json")
@@ -89,7 +102,7 @@ def main():
 
 
 @task(use_cache=True)
-async def run_experiment(config, data, behavior, repeats, iterations, evaluations, eval_scale, seed_base=4200):
+async def run_experiment(config, data, behavior, repeats, iterations, evaluations, eval_scale, seed_base=4200, eval_async=False):
 
     # points to evaluate at
     points = get_evaluation_points(iterations, evaluations, eval_scale)
@@ -97,10 +110,42 @@ async def run_experiment(config, data, behavior, repeats, iterations, evaluation
     # Evaluate at all points and all seeds
     results = []
     for seed in range(seed_base, seed_base + repeats):
-        results.append(ranking_run(config, data, behavior, points, seed))
+        results.append(ranking_run(config, data, behavior, points, seed, eval_async))
 
     # Await results to finish computing
-    final_results = [await r for r in results]
+    results = [await r for r in results]
+    return aggregate_runs(results, points)
+
+
+def run_experiments_in_processes(configs, data, behavior, repeats, iterations, evaluations, eval_scale, processes,
+                                 retries=2, cache="cache", seed_base=4200, eval_async=False):
+    """
+    Process-pool version of `run_experiment` for a list of configs. The
+    datasets are loaded into the task cache up front, so workers read them
+    from there instead of all parsing the same files. Every (config, seed)
+    run executes in a worker process with its own task executor, and only
+    configs and per-run results are pickled across processes.
+    """
+    points = get_evaluation_points(iterations, evaluations, eval_scale)
+    seeds = range(seed_base, seed_base + repeats)
+    with TaskExecutor(max_workers=1, memory=Memory(cache, compress=6)):
+        for seed in seeds:
+            load_train(data, seed)
+            load_test(data, seed)
+    jobs = [(config, data, behavior, points, seed, cache, eval_async) for config in configs for seed in seeds]
+    runs = run_in_processes(_process_run, jobs, processes, retries)
+    return [aggregate_runs(runs[i * repeats:(i + 1) * repeats], points) for i in range(len(configs))]
+
+
+def _process_run(config, data, behavior, points, seed, cache, eval_async):
+    logging.basicConfig(format=_LOG_FORMAT, level=logging.INFO)
+    with TaskExecutor(max_workers=1, memory=Memory(cache, compress=6)):
+        run = ranking_run(config, data, behavior, points, seed, eval_async)
+    return run.result
+
+
+def aggregate_runs(final_results, points):
+    # Combine results with different seeded repeats
     results = {
         "deploy": np.vstack([r["deploy"] for r in final_results]),
         "learned": np.vstack([r["learned"] for r in final_results]),
@@ -127,7 +172,7 @@ async def run_experiment(config, data, behavior, repeats, iterations, evaluation
 
 
 @task(use_cache=True)
-async def ranking_run(config, data, behavior, points, seed):
+async def ranking_run(config, data, behavior, points, seed, eval_async=False):
 
     # Load train, test and policy
     train = load_train(data, seed)
@@ -167,18 +212,25 @@ async def ranking_run(config, data, behavior, points, seed):
     indices = prng.randint(0, train.size, np.max(points))
 
     # Evaluate on point 0
-    out['deploy'][0], out['learned'][0] = evaluate(test, policy)
-    log_progress(0, points, seed, data, behavior, config, out, policy)
-
-    # Train and evaluate at specified points
-    for i in range(1, len(points)):
-        start = points[i - 1]
-        end = points[i]
-        out['regret'][i] = out['regret'][i - 1] + optimize(train, indices[start:end], policy, click_model)
-        out['deploy'][i], out['learned'][i] = evaluate(test, policy)
-        if hasattr(policy, 'ucb_baseline') and hasattr(policy, 'lcb_w'):
-            out['ucb_b'], out['lcb_w'] = policy.ucb_baseline, policy.lcb_w
-        log_progress(i, points, seed, data, behavior, config, out, policy)
+    evaluate_fn = evaluate_parallel if config.parallel_blocks > 0 else evaluate
+
+    def evaluate_point(index, policy):
+        out['deploy'][index], out['learned'][index] = evaluate_fn(test, policy)
+        log_progress(index, points, seed, data, behavior, config, out, policy)
+
+    with SnapshotEvaluator(eval_async, seed) as evaluator:
+        evaluator.submit(0, policy, partial(evaluate_point, 0))
+
+        # Train and evaluate at specified points
+        for i in range(1, len(points)):
+            start = points[i - 1]
+            end = points[i]
+            out['regret'][i] = out['regret'][i - 1] + optimize(train, indices[start:end], policy, click_model)
+            if hasattr(policy, 'ucb_baseline') and hasattr(policy, 'lcb_w'):
+                # Written per point before the submit, an evaluation still
+                # running on the previous snapshot never sees these values
+                out['ucb_b'][i], out['lcb_w'][i] = policy.ucb_baseline, policy.lcb_w
+            evaluator.submit(i, policy, partial(evaluate_point, i))
 
     return out
 
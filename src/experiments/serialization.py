@@ -0,0 +1,131 @@
+import os
+import sys
+import mmap
+import json
+import struct
+import hashlib
+import logging
+import tempfile
+import functools
+
+if sys.version_info >= (3, 8):
+    import pickle
+    _OUT_OF_BAND = True
+else:
+    try:
+        import pickle5 as pickle
+        _OUT_OF_BAND = True
+    except ImportError:
+        import pickle
+        _OUT_OF_BAND = False
+
+
+_MAGIC = b"EXPB0001"
+_ALIGN = 64
+
+
+def dumps(obj):
+    """
+    Pickles `obj` with protocol 5. Contiguous numpy arrays, which includes
+    the arrays in the state of all jitclass reducers, are returned as
+    out-of-band `PickleBuffer`s rather than being copied into the stream.
+    Before Python 3.8 this needs the `pickle5` backport, without it `obj` is
+    pickled in-band with protocol 4 and no buffers are returned.
+    """
+    if not _OUT_OF_BAND:
+        return pickle.dumps(obj, protocol=4), []
+    buffers = []
+    header = pickle.dumps(obj, protocol=5, buffer_callback=buffers.append)
+    return header, buffers
+
+
+def loads(header, buffers):
+    if not buffers:
+        return pickle.loads(header)
+    return pickle.loads(header, buffers=buffers)
+
+
+def save(obj, path):
+    """
+    Writes `obj` to `path` as its pickle header, followed by the out-of-band
+    buffers aligned to 64 bytes and a json table of their offsets. The file
+    is written next to `path` and renamed, so readers never see a partial
+    file.
+    """
+    header, buffers = dumps(obj)
+    raws = [b.raw() for b in buffers]
+    table = []
+    offset = _aligned(len(_MAGIC) + 8 + len(header))
+    for raw in raws:
+        table.append((offset, raw.nbytes, raw.readonly))
+        offset = _aligned(offset + raw.nbytes)
+    directory = os.path.dirname(path) or "."
+    os.makedirs(directory, exist_ok=True)
+    fd, tmp = tempfile.mkstemp(dir=directory)
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(_MAGIC)
+            f.write(struct.pack("<Q", len(header)))
+            f.write(header)
+            for (offset, _, _), raw in zip(table, raws):
+                f.write(b"\0" * (offset - f.tell()))
+                f.write(raw)
+            meta = json.dumps(table).encode()
+            f.write(meta)
+            f.write(struct.pack("<Q", len(meta)))
+        os.replace(tmp, path)
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+
+
+def load(path):
+    """
+    Loads an object written by `save`. The buffers are copy-on-write views of
+    a memory map of the file, so arrays are restored without copying and
+    stay writable unless they were read-only when saved. Files that are plain
+    pickles, as written before this format, are unpickled in full.
+    """
+    with open(path, "rb") as f:
+        if f.read(len(_MAGIC)) != _MAGIC:
+            f.seek(0)
+            return pickle.load(f)
+        data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY)
+        shared = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    view = memoryview(data)
+    readonly_view = memoryview(shared)
+    start = len(_MAGIC) + 8
+    length, = struct.unpack("<Q", view[len(_MAGIC):start])
+    meta_length, = struct.unpack("<Q", view[-8:])
+    table = json.loads(bytes(view[-8 - meta_length:-8]))
+    buffers = []
+    for offset, nbytes, readonly in table:
+        buffers.append((readonly_view if readonly else view)[offset:offset + nbytes])
+    return loads(view[start:start + length], buffers)
+
+
+def _aligned(offset):
+    return (offset + _ALIGN - 1) // _ALIGN * _ALIGN
+
+
+def cached_result(directory):
+    """
+    Caches the result of an async function in `directory` with `save`, keyed
+    by its arguments. A cache hit maps the stored arrays instead of
+    unpickling copies of them.
+    """
+    def decorator(fn):
+        @functools.wraps(fn)
+        async def wrapper(*args, **kwargs):
+            key = repr((fn.__module__, fn.__qualname__, args, sorted(kwargs.items())))
+            path = os.path.join(directory, hashlib.sha1(key.encode()).hexdigest())
+            if os.path.exists(path):
+                return load(path)
+            out = await fn(*args, **kwargs)
+            try:
+                save(out, path)
+            except OSError as e:
+                logging.warning(f"could not cache {fn.__qualname__} in {path}: {e}")
+            return out
+        return wrapper
+    return decorator
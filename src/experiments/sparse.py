@@ -1,9 +1,15 @@
 import numpy as np
 import numba
+from scipy.sparse import csr_matrix
 from rulpy.array import GrowingArray, GrowingArrayList
 from rulpy.array.growing_array import GrowingArrayF64, GrowingArrayI32
 
 
+# Rows and columns of the blocks of `csr_rows_dot`
+_ROW_BLOCK = 256
+_COLUMN_TILE = 32
+
+
 @numba.jitclass([
     ('data', numba.float64[:]),
     ('indices', numba.int32[:]),
@@ -31,6 +37,13 @@ class _SparseMatrix:
             (self.shape[1],)
         )
 
+    def row_dot_into(self, row, other, out):
+        if self.shape[1] != other.shape[0]:
+            raise ValueError("Incompatible dot product shapes")
+        out[:] = 0.0
+        _csr_row_dot_into(self, row, other, out)
+        return out
+
     def from_dense(self, matrix, transpose=False):
         _data = GrowingArrayF64(16)
         _indices = GrowingArrayI32(16)
@@ -108,6 +121,10 @@ def from_scipy(matrix, min_d=0):
     return SparseMatrix(matrix.data, matrix.indices, matrix.indptr, matrix.nnz, (matrix.shape[0], max(min_d, matrix.shape[1])))
 
 
+def to_scipy(matrix):
+    return csr_matrix((matrix.data, matrix.indices, matrix.indptr), shape=matrix.shape)
+
+
 def SparseMatrix(data, indices, indptr, nnz, shape):
     out = _SparseMatrix(data, indices, indptr, nnz, shape)
     setattr(out.__class__, '__getstate__', __matrix_getstate)
@@ -117,6 +134,53 @@ def SparseMatrix(data, indices, indptr, nnz, shape):
     return out
 
 
+@numba.njit(nogil=True)
+def csr_rows_dot(matrix, rows, other):
+    """
+    Computes the dense product of the subset `rows` of a CSR matrix with a
+    dense matrix, i.e. `matrix[rows, :] @ other`. The rows are processed in
+    blocks whose non-zeros are gathered into one contiguous CSR block, which
+    is then multiplied with one tile of columns of `other` at a time, so the
+    output block and the touched rows of the tile stay in cache.
+    """
+    if matrix.shape[1] != other.shape[0]:
+        raise ValueError("Incompatible dot product shapes")
+    out = np.zeros((rows.shape[0], other.shape[1]))
+    indptr = np.zeros(_ROW_BLOCK + 1, dtype=np.int64)
+    for start in range(0, rows.shape[0], _ROW_BLOCK):
+        end = min(rows.shape[0], start + _ROW_BLOCK)
+        nnz = 0
+        for i in range(start, end):
+            nnz += matrix.indptr[rows[i] + 1] - matrix.indptr[rows[i]]
+        data = np.empty(nnz)
+        indices = np.empty(nnz, dtype=np.int64)
+        nnz = 0
+        for i in range(start, end):
+            for j in range(matrix.indptr[rows[i]], matrix.indptr[rows[i] + 1]):
+                data[nnz] = matrix.data[j]
+                indices[nnz] = matrix.indices[j]
+                nnz += 1
+            indptr[i - start + 1] = nnz
+        for lo in range(0, other.shape[1], _COLUMN_TILE):
+            hi = min(other.shape[1], lo + _COLUMN_TILE)
+            for i in range(end - start):
+                for j in range(indptr[i], indptr[i + 1]):
+                    v = data[j]
+                    d = indices[j]
+                    for c in range(lo, hi):
+                        out[start + i, c] += other[d, c] * v
+    return out
+
+
+@numba.njit(nogil=True)
+def _csr_row_dot_into(matrix, row, other, out):
+    for i in range(matrix.indptr[row], matrix.indptr[row + 1]):
+        v = matrix.data[i]
+        d = matrix.indices[i]
+        for j in range(other.shape[1]):
+            out[j] += other[d, j] * v
+
+
 @numba.jitclass([
     ('data', numba.float64[:]),
     ('indices', numba.int32[:]),
@@ -133,6 +197,17 @@ class _SparseVector:
     def dot(self, other):
         return _sparse_vector_dot(self, other)
 
+    def dot_into(self, other, out):
+        if self.shape[0] != other.shape[0]:
+            raise ValueError("Incompatible dot product shapes")
+        out[:] = 0.0
+        for i in range(self.nnz):
+            v = self.data[i]
+            d = self.indices[i]
+            for j in range(other.shape[1]):
+                out[j] += other[d, j] * v
+        return out
+
     def to_dense(self):
         out = np.zeros(self.shape[0])
         for i in range(self.nnz):
@@ -244,3 +319,218 @@ def SparseVectorList(shape, capacity=16):
     setattr(out.__class__, '__reduce__', __vectorlist_reduce)
     setattr(out.__class__, '__deepcopy__', __vectorlist_deepcopy)
     return out
+
+
+@numba.njit(nogil=True)
+def _grow_i32(array, size):
+    if size < array.shape[0]:
+        return array
+    out = np.empty(max(16, 2 * array.shape[0]), dtype=np.int32)
+    out[:array.shape[0]] = array
+    return out
+
+
+@numba.njit(nogil=True)
+def _grow_i64(array, size):
+    if size < array.shape[0]:
+        return array
+    out = np.empty(max(16, 2 * array.shape[0]), dtype=np.int64)
+    out[:array.shape[0]] = array
+    return out
+
+
+@numba.njit(nogil=True)
+def _grow_f64(array, size):
+    if size < array.shape[0]:
+        return array
+    out = np.zeros(max(16, 2 * array.shape[0]), dtype=np.float64)
+    out[:array.shape[0]] = array
+    return out
+
+
+@numba.njit(nogil=True)
+def _hash(key):
+    h = key * -7046029254386353131
+    return h ^ (h >> 29)
+
+
+@numba.jitclass([
+    ('shape', numba.types.UniTuple(numba.int64, 2)),
+    ('table', numba.int64[:]),
+    ('keys', numba.int64[:]),
+    ('cols', numba.int32[:]),
+    ('data', numba.float64[:]),
+    ('data2', numba.float64[:]),
+    ('links', numba.int32[:]),
+    ('nnz', numba.int64),
+    ('row_table', numba.int64[:]),
+    ('rows', numba.int32[:]),
+    ('heads', numba.int32[:]),
+    ('n_rows', numba.int64)
+])
+class _SparseAccumulator:
+    """
+    Hash-based accumulator of sums and sums of squares over the cells of an
+    n x k matrix. Only cells that received a non-zero value are stored.
+
+    Every distinct row is assigned a slot on first use. The entries of a row
+    form a linked list starting at `heads[slot]` and following `links`, so
+    all entries of a row can be visited without scanning the full matrix.
+    """
+    def __init__(self, shape, table, keys, cols, data, data2, links, nnz, row_table, rows, heads, n_rows):
+        self.shape = shape
+        self.table = table
+        self.keys = keys
+        self.cols = cols
+        self.data = data
+        self.data2 = data2
+        self.links = links
+        self.nnz = nnz
+        self.row_table = row_table
+        self.rows = rows
+        self.heads = heads
+        self.n_rows = n_rows
+
+    def add(self, row, col, value):
+        if value == 0.0:
+            return
+        entry = self.entry(row, col)
+        if entry < 0:
+            entry = self._insert(row, col)
+        self.data[entry] += value
+        self.data2[entry] += value * value
+
+    def get(self, row, col):
+        entry = self.entry(row, col)
+        if entry < 0:
+            return 0.0
+        return self.data[entry]
+
+    def get2(self, row, col):
+        entry = self.entry(row, col)
+        if entry < 0:
+            return 0.0
+        return self.data2[entry]
+
+    def entry(self, row, col):
+        key = row * self.shape[1] + col
+        mask = self.table.shape[0] - 1
+        h = _hash(key) & mask
+        while self.table[h] >= 0:
+            if self.keys[self.table[h]] == key:
+                return self.table[h]
+            h = (h + 1) & mask
+        return -1
+
+    def _slot(self, row):
+        mask = self.row_table.shape[0] - 1
+        h = _hash(row) & mask
+        while self.row_table[h] >= 0:
+            if self.rows[self.row_table[h]] == row:
+                return self.row_table[h]
+            h = (h + 1) & mask
+        slot = self.n_rows
+        self.rows = _grow_i32(self.rows, slot)
+        self.heads = _grow_i32(self.heads, slot)
+        self.rows[slot] = row
+        self.heads[slot] = -1
+        self.row_table[h] = slot
+        self.n_rows += 1
+        if 2 * self.n_rows > self.row_table.shape[0]:
+            self.row_table = np.full(2 * self.row_table.shape[0], -1, dtype=np.int64)
+            mask = self.row_table.shape[0] - 1
+            for s in range(self.n_rows):
+                h = _hash(self.rows[s]) & mask
+                while self.row_table[h] >= 0:
+                    h = (h + 1) & mask
+                self.row_table[h] = s
+        return slot
+
+    def _insert(self, row, col):
+        slot = self._slot(row)
+        entry = self.nnz
+        self.keys = _grow_i64(self.keys, entry)
+        self.cols = _grow_i32(self.cols, entry)
+        self.data = _grow_f64(self.data, entry)
+        self.data2 = _grow_f64(self.data2, entry)
+        self.links = _grow_i32(self.links, entry)
+        self.keys[entry] = row * self.shape[1] + col
+        self.cols[entry] = col
+        self.data[entry] = 0.0
+        self.data2[entry] = 0.0
+        self.links[entry] = self.heads[slot]
+        self.heads[slot] = entry
+        self.nnz += 1
+        start = entry
+        if 2 * self.nnz > self.table.shape[0]:
+            self.table = np.full(2 * self.table.shape[0], -1, dtype=np.int64)
+            start = 0
+        mask = self.table.shape[0] - 1
+        for e in range(start, self.nnz):
+            h = _hash(self.keys[e]) & mask
+            while self.table[h] >= 0:
+                h = (h + 1) & mask
+            self.table[h] = e
+        return entry
+
+
+def __accumulator_getstate(self):
+    return {
+        'shape': self.shape,
+        'table': self.table,
+        'keys': self.keys[:self.nnz],
+        'cols': self.cols[:self.nnz],
+        'data': self.data[:self.nnz],
+        'data2': self.data2[:self.nnz],
+        'links': self.links[:self.nnz],
+        'nnz': self.nnz,
+        'row_table': self.row_table,
+        'rows': self.rows[:self.n_rows],
+        'heads': self.heads[:self.n_rows],
+        'n_rows': self.n_rows
+    }
+
+
+def __accumulator_setstate(self, state):
+    self.shape = state['shape']
+    self.table = state['table']
+    self.keys = state['keys']
+    self.cols = state['cols']
+    self.data = state['data']
+    self.data2 = state['data2']
+    self.links = state['links']
+    self.nnz = state['nnz']
+    self.row_table = state['row_table']
+    self.rows = state['rows']
+    self.heads = state['heads']
+    self.n_rows = state['n_rows']
+
+
+def __accumulator_reduce(self):
+    return (SparseAccumulator, (self.shape,), self.__getstate__())
+
+
+def __accumulator_deepcopy(self):
+    state = {key: np.copy(value) if isinstance(value, np.ndarray) else value
+             for key, value in self.__getstate__().items()}
+    return SparseAccumulator(**state)
+
+
+def SparseAccumulator(shape, table=None, keys=None, cols=None, data=None, data2=None, links=None, nnz=0,
+                      row_table=None, rows=None, heads=None, n_rows=0):
+    table = np.full(16, -1, dtype=np.int64) if table is None else table
+    keys = np.zeros(16, dtype=np.int64) if keys is None else keys
+    cols = np.zeros(16, dtype=np.int32) if cols is None else cols
+    data = np.zeros(16, dtype=np.float64) if data is None else data
+    data2 = np.zeros(16, dtype=np.float64) if data2 is None else data2
+    links = np.zeros(16, dtype=np.int32) if links is None else links
+    row_table = np.full(16, -1, dtype=np.int64) if row_table is None else row_table
+    rows = np.zeros(16, dtype=np.int32) if rows is None else rows
+    heads = np.zeros(16, dtype=np.int32) if heads is None else heads
+    out = _SparseAccumulator((int(shape[0]), int(shape[1])), table, keys, cols, data, data2, links, nnz,
+                             row_table, rows, heads, n_rows)
+    setattr(out.__class__, '__getstate__', __accumulator_getstate)
+    setattr(out.__class__, '__setstate__', __accumulator_setstate)
+    setattr(out.__class__, '__reduce__', __accumulator_reduce)
+    setattr(out.__class__, '__deepcopy__', __accumulator_deepcopy)
+    return out
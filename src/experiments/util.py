@@ -4,9 +4,14 @@ import os
 import json
 import dlib
 import logging
+import resource
+import multiprocessing
+from collections import deque
 from rulpy.pipeline.task_executor import task
 from skopt.space import Real, Integer, Categorical, Space
-from threading import Semaphore, Lock
+from threading import Semaphore, Lock, Event, Thread
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, wait, FIRST_COMPLETED
+from concurrent.futures.process import BrokenProcessPool
 
 
 @numba.njit(nogil=True)
@@ -59,6 +64,192 @@ class NumpyEncoder(json.JSONEncoder):
         return json.JSONEncoder.default(self, obj)
 
 
+def run_in_processes(fn, jobs, processes, retries=2, budget=None, profiles=None):
+    """
+    Calls `fn(*job)` for every job in a pool of `processes` spawned worker
+    processes and returns the results in job order. Exceptions raised by
+    `fn` propagate. If a worker dies instead (e.g. a segfault in a numba
+    kernel), the pool is restarted and the unfinished jobs are resubmitted.
+    Jobs that were running alongside the crash are rerun one at a time
+    first, so a crash is only charged to the job that caused it, which is
+    retried at most `retries` times.
+
+    With a `MemoryBudget`, job `i` is only started once its estimated peak
+    memory for `profiles[i] = (key, estimate)` fits next to the running
+    jobs, and its measured peak RSS is recorded under `key`.
+    """
+    results = [None] * len(jobs)
+    attempts = [0] * len(jobs)
+    pending = deque(range(len(jobs)))
+    suspects = deque()
+    context = multiprocessing.get_context('spawn')
+    while pending or suspects:
+        queue, workers = (suspects, 1) if suspects else (pending, processes)
+        running = {}
+        crashed = []
+        with ProcessPoolExecutor(workers, mp_context=context) as executor:
+            while (queue or running) and not crashed:
+                while queue and len(running) < workers:
+                    need = budget.estimate(*profiles[queue[0]]) if budget is not None else 0
+                    if budget is not None and not budget.acquire(need, force=not running):
+                        break
+                    i = queue.popleft()
+                    running[executor.submit(_measured, fn, jobs[i])] = (i, need)
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    job = running.pop(future)
+                    if not _collect(future, job, results, budget, profiles):
+                        crashed.append((job[0], future))
+            for future in list(running):
+                job = running.pop(future)
+                if not _collect(future, job, results, budget, profiles):
+                    crashed.append((job[0], future))
+        if len(crashed) == 1:
+            i, future = crashed[0]
+            attempts[i] += 1
+            if attempts[i] > retries:
+                future.result()
+            logging.warning(f"job {i} killed its worker process, retrying it")
+            queue.appendleft(i)
+        elif crashed:
+            logging.warning(f"worker process died, rerunning {len(crashed)} jobs one at a time")
+            suspects.extend(i for i, _ in crashed)
+    return results
+
+
+def _collect(future, job, results, budget, profiles):
+    # Returns False if the worker process of `future` died
+    i, need = job
+    if budget is not None:
+        budget.release(need)
+    try:
+        results[i], peak = future.result()
+    except BrokenProcessPool:
+        return False
+    if budget is not None:
+        budget.record(profiles[i][0], peak)
+    return True
+
+
+def _measured(fn, args):
+    # Runs fn(*args) while sampling the anonymous resident memory of the process
+    peak = [_rss()]
+    done = Event()
+
+    def sample():
+        while not done.wait(0.1):
+            peak[0] = max(peak[0], _rss())
+
+    sampler = Thread(target=sample, daemon=True)
+    sampler.start()
+    try:
+        out = fn(*args)
+    finally:
+        done.set()
+        sampler.join()
+    return out, max(peak[0], _rss())
+
+
+def _rss():
+    # Anonymous memory only, pages of memory-mapped files can be reclaimed
+    try:
+        with open("/proc/self/status", "rt") as f:
+            for line in f:
+                if line.startswith("RssAnon:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+class MemoryBudget():
+    """
+    Admission control for `run_in_processes`. Jobs reserve their estimated
+    peak memory against `budget` bytes. Peaks observed for a key are kept in
+    the json file `path`. Once a key has an observation it replaces the
+    static estimate, with a safety `margin`. Every new peak is recorded as
+    the larger of the peak and the previous observation scaled by `decay`,
+    so an outlier is forgotten after a few runs.
+    """
+    def __init__(self, budget, path=".cache/memory.json", margin=1.2, decay=0.5):
+        self.budget = budget
+        self.path = path
+        self.margin = margin
+        self.decay = decay
+        self.in_use = 0
+        self.observed = {}
+        if os.path.exists(path):
+            with open(path, "rt") as f:
+                self.observed = json.load(f)
+
+    def estimate(self, key, estimate):
+        if key in self.observed:
+            return int(self.margin * self.observed[key])
+        return estimate
+
+    def acquire(self, need, force=False):
+        if not force and self.in_use + need > self.budget:
+            return False
+        self.in_use += need
+        return True
+
+    def release(self, need):
+        self.in_use -= need
+
+    def record(self, key, peak):
+        self.observed[key] = max(peak, int(self.decay * self.observed.get(key, 0)))
+        mkdir_if_not_exists(self.path)
+        with open(self.path, "wt") as f:
+            json.dump(self.observed, f, indent=2)
+
+
+class SnapshotEvaluator():
+    """
+    Runs the evaluation of a policy at an evaluation point. If `asynchronous`
+    is set, `fn` gets a copy of the policy made by `snapshot`, by default a
+    deep copy, and runs on a worker thread while training continues. At most
+    one evaluation is in flight, so a further `submit` waits for the
+    previous one, and evaluations finish in order. The worker's numba random
+    state is seeded per point.
+    """
+    def __init__(self, asynchronous=False, seed=None, snapshot=None):
+        self.asynchronous = asynchronous
+        self.seed = seed
+        self.snapshot = snapshot if snapshot is not None else lambda policy: policy.__deepcopy__()
+        self._executor = ThreadPoolExecutor(1) if asynchronous else None
+        self._future = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def submit(self, index, policy, fn):
+        if not self.asynchronous:
+            fn(policy)
+            return
+        self.wait()
+        self._future = self._executor.submit(self._run, index, self.snapshot(policy), fn)
+
+    def _run(self, index, snapshot, fn):
+        if self.seed is not None:
+            _numba_rng_seed(self.seed + index)
+        fn(snapshot)
+
+    def wait(self):
+        if self._future is not None:
+            future, self._future = self._future, None
+            future.result()
+
+    def close(self):
+        if self._executor is not None:
+            try:
+                self.wait()
+            finally:
+                self._executor.shutdown()
+
+
 class HyperOptimizer():
     def __init__(self, target_fn, space, maximize=True, max_parallel=5, kwargs={}):
         self.target_fn = target_fn